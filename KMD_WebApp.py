@@ -1,45 +1,640 @@
+import functools
+import os
+import tempfile
+import threading
+import time
+import uuid
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import streamlit as st
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-mpl.style.use('ggplot')
-from matplotlib.colors import LinearSegmentedColormap
-from sklearn.cluster import KMeans
 from PIL import Image
 from io import BytesIO
-from renishawWiRE import WDFReader
 
-from scipy.ndimage import gaussian_filter
-from scipy.ndimage import binary_dilation
 
-
-# Tasks - General functions section
+from kmd_cache import ByteLRUCache, DiskCache
+from kmd_cluster import SWEEP_KS, ClusterModel, ClusterSweep, ModelStore
+from kmd_instrument import ENABLED as INSTRUMENTED, allocated, array_bytes, recording, stage, staged
+from kmd_io import Region, content_hash, region_view
+from kmd_jobs import JobBoard
+from kmd_layers import (LAYER_COLOURS, Layer, colourise, composite_layers, encode_png, generate_layers, layer_name,
+                        layers_zip, make_black_pixels_transparent, parse_layer_specs, postprocess_layer, renumber_layers,
+                        to_image)
+from kmd_pipeline import (DEFAULT_BUDGET_BYTES, assign_to_preview, block_pixels, cached_basis, cluster,
+                          effective_reduction, model_settings, open_cube, prewarm_clustering, working_set_bytes)
+from kmd_preprocess import NO_PREPROCESSING, Preprocessing
+from kmd_reduce import NO_REDUCTION, Reduction
+from kmd_render import (cluster_legend_image, cluster_map_image, colourbar_image, figure_image, highlight_map_image,
+                        layers_figure, named_lut)
+from kmd_session import Session, export_session, import_session
+from kmd_spatial import NO_SPATIAL, Spatial, feature_settings
+from kmd_spectra import WavenumberIndex, band_intensity_map, cluster_mean_spectra
+from kmd_view import interactive_view_html, pixel_spectra_payload
 
 
+# Tasks - General functions section
 
-def cluster_select(original_df, cluster):
-    # Create a copy of the original DataFrame
-    df_copy = original_df.copy()
 
-    # Set all values in rows not related to the specified index to zero
-    df_copy.loc[df_copy.index != cluster, :] = 0
 
-    return df_copy
+def parse_band_range(start, end):
+    # Wavenumber range typed by the user, or None if either end is not a number
+    try:
+        return float(start), float(end)
+    except ValueError:
+        return None
 
-def select_range(input_df, start_column, end_column):
-    # Convert column labels to a list for validation
-    column_labels = list(input_df.columns)
 
-    # Check if start and end columns are valid
-    if start_column not in column_labels or end_column not in column_labels:
-        st.error("Please enter valid column labels.")
+def session_memory_limit():
+    # KMD_SESSION_MEMORY_MB caps what one browser session may hold and compute with (0 = no limit)
+    return int(os.environ.get('KMD_SESSION_MEMORY_MB', 0)) * 1024 * 1024
+
+def session_held_bytes():
+    # Arrays and files the session keeps between runs: layers, prepared downloads and the interactive view
+    return array_bytes([st.session_state.get(key) for key in ('layers', 'session_zip', 'batch_zip', 'interactive_view', 'final_figure')])
+
+def check_memory(needed_bytes):
+    # Refuse work that would take the session over its memory ceiling, before anything is allocated
+    limit = session_memory_limit()
+    held = session_held_bytes()
+    if limit and needed_bytes + held > limit:
+        mb = lambda value: value / 1024 ** 2
+        raise MemoryError(f"this needs about {mb(needed_bytes):.0f} MB on top of the {mb(held):.0f} MB the session "
+                          f"holds, over the {mb(limit):.0f} MB allowed per session. Use streaming, a preview or "
+                          f"a region of interest, or remove layers.")
+
+@functools.lru_cache(maxsize=None)
+def pyplot():
+    # matplotlib takes longer to import than the rest of the app, so only the pages that plot load it
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    mpl.style.use('ggplot')
+    return plt
+
+def prewarm(pool, workers):
+    # Import the clustering and plotting stack ahead of the first request, and start the sweep workers
+    pyplot()
+    prewarm_clustering()
+    if pool is not None:
+        for _ in range(workers):
+            pool.submit(prewarm_clustering)
+
+@st.cache_resource
+def start_prewarm():
+    # KMD_PREWARM=1: warm up once per server process, in the background, after the first page is drawn
+    if os.environ.get('KMD_PREWARM', '0').strip().lower() in ('0', 'false', 'off', 'no', ''):
         return None
+    thread = threading.Thread(target=prewarm, args=(get_sweep_pool(), sweep_workers()), name='kmd-prewarm',
+                              daemon=True)
+    thread.start()
+    return thread
+
+def disk_cache(name):
+    # Optional disk tier shared by the server processes: KMD_CACHE_DIR, bounded by KMD_CACHE_DISK_MB
+    directory = os.environ.get('KMD_CACHE_DIR')
+    if not directory:
+        return None
+    max_mb = int(os.environ.get('KMD_CACHE_DISK_MB', 10240))
+    return DiskCache(os.path.join(directory, name), max_bytes=max_mb * 1024 * 1024)
+
+@st.cache_resource
+def get_cube_cache():
+    # One cache per server process, so a file opened by several users is parsed once
+    max_mb = int(os.environ.get('KMD_CUBE_CACHE_MB', 2048))
+    return ByteLRUCache(max_bytes=max_mb * 1024 * 1024, disk=disk_cache('cubes'))
+
+@staged('load')
+def load_cube(uploaded_file, streaming=False):
+    # Hash each upload once per session; reruns reuse the stored key
+    hashes = st.session_state.setdefault('upload_hashes', {})
+    if uploaded_file.file_id not in hashes:
+        hashes[uploaded_file.file_id] = content_hash(uploaded_file.getvalue())
+    dataset_key = hashes[uploaded_file.file_id]
+
+    # Streaming mode views the DATA block of the upload in place instead of decoding a copy
+    if streaming:
+        return dataset_key, open_cube(uploaded_file.getvalue(), streaming=True)
+
+    # The decoded spectra take about as much memory as the file. Checked here rather than in the loader, which
+    # other sessions waiting on the same upload share and which must not fail for them
+    cache = get_cube_cache()
+    if dataset_key not in cache:
+        check_memory(uploaded_file.size)
+
+    def parse():
+        cube = open_cube(uploaded_file.getvalue())
+        allocated(cube)
+        return cube
+
+    cube = cache.get_or_load(dataset_key, parse)
+
+    return dataset_key, cube
+
+def region_wanted():
+    # ROI and preview read the upload through the memory-mapped view instead of decoding all of it
+    return st.session_state.get('roi', False) or st.session_state.get('preview_step', 1) > 1
+
+def region_cube(region_key, cube, region):
+    # Regions that are not one contiguous block of rows are gathered once and cached like uploads
+    view = region_view(cube, region)
+    if view.spectra.flags.c_contiguous:
+        return view
+
+    def gather():
+        spectra = np.ascontiguousarray(view.spectra)
+        allocated(spectra)
+        return view._replace(spectra=spectra)
+
+    return get_cube_cache().get_or_load((region_key, 'region'), gather)
+
+def select_region(dataset_key, cube):
+    """Dataset key and cube to cluster, plus the preview the full-resolution labels come from.
+
+    With a preview step of n, every nth row and column is clustered first and the page
+    shows that map. Once full resolution is asked for, every pixel of the region is
+    assigned to the preview's centroids and (key, cube, (preview_key, preview_cube)) is
+    returned; otherwise the third item is None.
+    """
+    rows, cols = cube.shape[:2]
+    with st.sidebar.expander("Region and preview"):
+        region = Region()
+        if st.checkbox("Cluster a region of interest", key='roi'):
+            region = region._replace(
+                rows=st.slider("Rows", 0, rows, (0, rows), key=f'roi_rows_{rows}'),
+                cols=st.slider("Columns", 0, cols, (0, cols), key=f'roi_cols_{cols}'))
+        step = int(st.number_input("Preview: every Nth pixel", min_value=1, max_value=16, value=1, key='preview_step',
+                                   help="Cluster a subsample first; full-resolution labels are assigned on request."))
+
+    if region.rows is not None:
+        dataset_key = f"{dataset_key}:roi{region.rows[0]}-{region.rows[1]}x{region.cols[0]}-{region.cols[1]}"
+        cube = region_cube(dataset_key, cube, region)
+    if step == 1:
+        return dataset_key, cube, None
+
+    preview_key = f"{dataset_key}:step{step}"
+    preview_cube = region_cube(preview_key, cube, Region(step=step))
+    if not st.checkbox(f"Full-resolution labels ({cube.shape[0]}x{cube.shape[1]} pixels)", key=f'full_{preview_key}'):
+        st.caption(f"Preview on a 1-in-{step} grid ({preview_cube.shape[0]}x{preview_cube.shape[1]} map)")
+        return preview_key, preview_cube, None
+    return dataset_key, cube, (preview_key, preview_cube)
+
+# Size of the matplotlib figure the old page 3 saved, and of the map page 4 cut out of it
+LEGACY_FIGURE_SIZE = (800, 600)
+LEGACY_COMBINED_SIZE = (586, 497)
+
+def crop_legacy(image, legacy_size, box):
+    # Cut the fixed box out of images in the old figure layout; images from the current pages are used as they are
+    return image.crop(box) if image.size == legacy_size else image
+
+def streaming_controls():
+    # Low-memory clustering for maps that do not fit in RAM
+    with st.sidebar.expander("Large maps"):
+        streaming = st.checkbox("Streaming (low-memory) clustering", key='streaming')
+        budget_mb = st.number_input("Memory budget (MB)", min_value=16, key='budget_mb',
+                                    value=int(os.environ.get('KMD_MEMORY_BUDGET_MB', 256)))
+
+    return streaming, int(budget_mb) * 1024 * 1024
+
+def preprocessing_controls():
+    # Spectral preprocessing ahead of clustering; the plots keep showing the raw spectra
+    with st.sidebar.expander("Preprocessing"):
+        crop = None
+        if st.checkbox("Crop to a spectral region", key='pp_crop'):
+            col_start, col_end = st.columns(2)
+            crop = (float(col_start.number_input("From", value=400.0, key='pp_crop_start')),
+                    float(col_end.number_input("To", value=1800.0, key='pp_crop_end')))
+        despike = st.number_input("Cosmic-ray threshold (0 = off)", min_value=0.0, value=0.0, step=1.0, key='pp_despike')
+        baseline = st.selectbox("Baseline removal", ["None", "Polynomial", "ALS"], key='pp_baseline')
+        poly_order, als_lambda, als_p = 3, 1e5, 0.01
+        if baseline == "Polynomial":
+            poly_order = st.number_input("Polynomial order", min_value=1, max_value=10, value=3, key='pp_poly_order')
+        elif baseline == "ALS":
+            als_lambda = st.number_input("ALS smoothness (lambda)", min_value=1.0, value=1e5, format="%g", key='pp_als_lambda')
+            als_p = st.number_input("ALS asymmetry (p)", min_value=0.001, max_value=0.5, value=0.01, format="%g", key='pp_als_p')
+        normalise = st.selectbox("Normalisation", ["None", "Vector", "Area"], key='pp_normalise')
+
+    baselines = {"None": 'none', "Polynomial": 'poly', "ALS": 'als'}
+    return Preprocessing(crop=crop, despike=float(despike), baseline=baselines[baseline], poly_order=int(poly_order),
+                         als_lambda=float(als_lambda), als_p=float(als_p), normalise=normalise.lower())
+
+def reduction_controls():
+    # Cluster on principal-component scores instead of every channel
+    with st.sidebar.expander("Dimensionality reduction"):
+        method = st.selectbox("Reduction", ["None", "Randomized SVD", "Incremental PCA"], key='rd_method',
+                              help="Incremental PCA reads the map a block at a time and is used for streaming.")
+        if method == "None":
+            return NO_REDUCTION
+        target = st.radio("Keep", ["Components", "Explained variance"], key='rd_target', horizontal=True)
+        components = st.number_input("Components" if target == "Components" else "Maximum components",
+                                     min_value=1, max_value=200, value=20, key='rd_components')
+        variance = 0.0
+        if target == "Explained variance":
+            variance = st.slider("Variance kept", min_value=0.5, max_value=0.999, value=0.99, key='rd_variance')
+
+    methods = {"Randomized SVD": 'svd', "Incremental PCA": 'incremental'}
+    return Reduction(method=methods[method], components=int(components), variance=float(variance))
+
+def spatial_controls():
+    # Bring neighbouring pixels into the clustering: before the fit, after it, or both
+    with st.sidebar.expander("Spatial clustering"):
+        radius = st.number_input("Neighbourhood radius (0 = off)", min_value=0, max_value=5, value=0, key='sp_radius',
+                                 help="Blend each spectrum with the mean of the surrounding pixels before K-means.")
+        weight = 0.5
+        if radius > 0:
+            weight = st.slider("Neighbourhood weight", min_value=0.0, max_value=1.0, value=0.5, key='sp_weight')
+        beta = st.number_input("Label smoothing (0 = off)", min_value=0.0, max_value=10.0, value=0.0, step=0.25,
+                               key='sp_beta', help="Potts smoothing: how strongly pixels follow their neighbours' clusters.")
+        min_size = st.number_input("Minimum region size in pixels (0 = off)", min_value=0, value=0, key='sp_min_size')
+
+    return Spatial(radius=int(radius), weight=float(weight), beta=float(beta), min_size=int(min_size))
+
+def show_reduction_caption(dataset_key, preprocessing, reduction):
+    basis = cached_basis(get_cube_cache(), dataset_key, preprocessing, reduction)
+    if basis is not None:
+        st.caption(f"Clustering on {len(basis.components)} components "
+                   f"({basis.explained_variance_ratio.sum():.1%} of the variance)")
+
+@st.cache_resource
+def get_model_store():
+    # Fitted models are shared by every page, so view-only changes never refit
+    max_mb = int(os.environ.get('KMD_MODEL_CACHE_MB', 512))
+    return ModelStore(max_bytes=max_mb * 1024 * 1024, disk=disk_cache('models'))
+
+def sweep_workers():
+    # KMD_SWEEP_WORKERS=0 turns the background k sweep off
+    return int(os.environ.get('KMD_SWEEP_WORKERS', os.cpu_count() or 1))
+
+# Finished sweeps whose elbow-plot scores are kept after the sweep itself is dropped
+SWEEPS_KEPT = 64
+
+def new_sweep_pool():
+    workers = sweep_workers()
+    if workers <= 0:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+@st.cache_resource
+def get_sweeps():
+    # Per server process: the worker pool, the running sweeps (a Future while one is being started),
+    # the sessions waiting on each and the (ks, scores) of finished ones
+    return {'pool': new_sweep_pool(), 'running': {}, 'owners': {}, 'finished': OrderedDict()}, threading.Lock()
+
+def get_sweep_pool():
+    state, lock = get_sweeps()
+    with lock:
+        return state['pool']
+
+def retire_sweeps(state):
+    # Under the lock: finished sweeps leave only their scores behind, so nothing holds their models
+    for key, sweep in list(state['running'].items()):
+        if isinstance(sweep, ClusterSweep) and sweep.done():
+            del state['running'][key]
+            state['owners'].pop(key, None)
+            # Fits lost to a dead worker are tried again by the next sweep rather than remembered as done
+            if not any(isinstance(error, BrokenProcessPool) for error in sweep.errors.values()):
+                state['finished'][key] = (sweep.ks, dict(sweep.scores))
+    while len(state['finished']) > SWEEPS_KEPT:
+        state['finished'].popitem(last=False)
+
+def start_sweep(state, lock, store, owner, dataset_key, data_matrix, preprocessing=NO_PREPROCESSING):
+    # Start fitting every slider value in the background, once per dataset and model settings, with
+    # `owner` (a session) waiting on it; None when there is nothing to wait for (already swept,
+    # or the pool had to be replaced)
+    key = (dataset_key, preprocessing)
+    running, owners = state['running'], state['owners']
+    with lock:
+        retire_sweeps(state)
+        if key in state['finished']:
+            return None
+        # This owner no longer wants its sweeps of the file's earlier settings, regions and previews;
+        # their queued fits are dropped once no other session waits on them either
+        same_file = [other for other in running
+                     if other != key and other[0].split(':')[0] == dataset_key.split(':')[0]]
+        for other in same_file:
+            owners[other].discard(owner)
+            if not owners[other]:
+                del owners[other]
+                stale = running.pop(other)
+                if isinstance(stale, ClusterSweep):
+                    stale.cancel()
+        owners.setdefault(key, set()).add(owner)
+        sweep = running.get(key)
+        if sweep is not None:
+            placeholder = None
+        else:
+            placeholder = running[key] = Future()
+            pool = state['pool']
+    if isinstance(sweep, Future):
+        # Another session is still writing the data matrix for this sweep
+        return sweep.result()
+    if placeholder is None:
+        return sweep
+
+    # Writing the data matrix for the workers takes a while, so it happens outside the lock,
+    # with other sessions waiting on the placeholder
+    try:
+        sweep = ClusterSweep(pool, store, dataset_key, data_matrix, preprocessing=preprocessing)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed when out of memory): later sweeps get a new pool, this k is fitted in the job
+        with lock:
+            if state['pool'] is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                state['pool'] = new_sweep_pool()
+    finally:
+        with lock:
+            if running.get(key) is placeholder and sweep is not None:
+                running[key] = sweep
+            elif running.get(key) is placeholder:
+                del running[key]
+                owners.pop(key, None)
+            elif sweep is not None:
+                # Dropped by its owners while the matrix was written
+                sweep.cancel()
+                sweep = None
+        placeholder.set_result(sweep)
+    return sweep
+
+def wait_for_sweep(sweeps, store, owner):
+    # Hook for kmd_pipeline.cluster: the background sweep's fit for k, started if it is not running yet
+    def fitted(dataset_key, data_matrix, k, settings, progress):
+        sweep = start_sweep(*sweeps, store, owner, dataset_key, data_matrix, settings)
+        if sweep is None:
+            return None
+        while sweep.pending(k):
+            progress(0, 0, "Waiting for the background fit")
+            time.sleep(0.2)
+        return sweep.result(k)
+
+    return fitted
+
+def clustering_method(streaming, budget_bytes, preview=None):
+    # How a model was produced, the last part of its ModelStore key
+    if preview is not None:
+        return 'assigned', preview[0]
+    return ('streaming', budget_bytes) if streaming else 'full'
+
+@staged('cluster')
+def get_clusters(dataset_key, cube, num_clusters, streaming=False, budget_bytes=None,
+                 preprocessing=NO_PREPROCESSING, reduction=NO_REDUCTION, preview=None, spatial=NO_SPATIAL):
+    # Fitted model from the store, or from a background job while the page shows its progress
+    store = get_model_store()
+    budget_bytes = budget_bytes or DEFAULT_BUDGET_BYTES
+    reduction = effective_reduction(reduction, streaming)
+    settings = model_settings(preprocessing, reduction, spatial)
+    method = clustering_method(streaming, budget_bytes, preview)
+
+    model = store.get(dataset_key, num_clusters, settings, method)
+    if model is None and preview is not None:
+        # Full-resolution labels from the preview's centroids instead of a fit on every pixel
+        preview_key, preview_cube = preview
+        preview_model = get_clusters(preview_key, preview_cube, num_clusters, streaming, budget_bytes,
+                                     preprocessing, reduction, spatial=spatial)
+        check_memory(working_set_bytes(cube, num_clusters, streaming=True, budget_bytes=budget_bytes,
+                                       spatial=spatial._replace(radius=0)))
+        if spatial.radius > 0:
+            st.caption("Neighbourhood features are used for the preview fit only.")
+        assign = functools.partial(assign_to_preview, cache=get_cube_cache(), preview_key=preview_key)
+        model = run_job('cluster', (dataset_key, num_clusters, settings, method), assign, cube, preview_cube,
+                        preview_model.centroids, streaming, budget_bytes, preprocessing, reduction, spatial)
+        allocated(model)
+        store.put(dataset_key, num_clusters, model, settings, method)
+        return model
+    if model is None:
+        check_memory(working_set_bytes(cube, num_clusters, preprocessing, reduction, streaming, budget_bytes, spatial))
+        sweep = None if streaming or get_sweep_pool() is None else wait_for_sweep(get_sweeps(), store, session_id())
+        # The pipeline's own clustering, sharing the cube cache and model store with every session
+        fit = functools.partial(cluster, cache=get_cube_cache(), store=store, key=dataset_key, sweep=sweep)
+        model = run_job('cluster', (dataset_key, num_clusters, settings, method), fit, cube, num_clusters, streaming,
+                        budget_bytes, preprocessing, reduction, 1, spatial)
+        allocated(model)
+
+    show_reduction_caption(dataset_key, preprocessing, reduction)
+    return model
+
+@st.cache_resource
+def get_job_board():
+    # Threads rather than processes: jobs share the caches, and NumPy/scikit-learn release the GIL
+    workers = int(os.environ.get('KMD_JOB_WORKERS', 2))
+    return JobBoard(ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='kmd-job'))
+
+def session_id():
+    return st.session_state.setdefault('session_id', uuid.uuid4().hex)
+
+def run_job(slot, key, func, *args, wait=True):
+    """Result of func(*args) run as a background job, once it has finished.
+
+    Until then the page shows its progress: with `wait` the page stops there, otherwise
+    None is returned. A session runs one job per slot; asking for a different key cancels
+    the previous job unless another session is waiting for it too.
+    """
+    board = get_job_board()
+    jobs = st.session_state.setdefault('jobs', {})
+    previous = jobs.get(slot)
+    if previous is not None and previous.key != key:
+        board.release(previous.key, session_id())
+
+    if st.session_state.get('cancelled_jobs', {}).get(slot) == key:
+        st.info("Cancelled.")
+        if not st.button("Restart", key=f'restart_{slot}'):
+            if wait:
+                st.stop()
+            return None
+        del st.session_state['cancelled_jobs'][slot]
+
+    job = previous if previous is not None and previous.key == key and not previous.cancelled() else None
+    if job is None:
+        job = jobs[slot] = board.submit(key, session_id(), func, *args)
+
+    if job.done():
+        del jobs[slot]
+        board.release(key, session_id())
+        return job.result()
+
+    show_job_progress(slot, job)
+    if wait:
+        st.stop()
+    return None
+
+@st.fragment(run_every=0.5)
+def show_job_progress(slot, job):
+    # Redrawn on its own every half second; the whole page reruns once the job has finished
+    if job.done():
+        st.rerun()
+    steps = f" {job.done_steps}/{job.total_steps}" if job.total_steps else ""
+    st.progress(job.fraction(), text=f"{job.message or 'Queued'}{steps} ({time.time() - job.started:.0f} s)")
+    if st.button("Cancel", key=f'cancel_{slot}'):
+        st.session_state.setdefault('cancelled_jobs', {})[slot] = job.key
+        del st.session_state['jobs'][slot]
+        get_job_board().release(job.key, session_id())
+        st.rerun()
+
+def show_debug_panel(recorder):
+    # Stage timings and memory of this run (KMD_INSTRUMENT=0 removes the panel)
+    history = st.session_state.setdefault('run_history', [])
+    history.append({'page': recorder.run_name, 'seconds': round(recorder.total_seconds(), 3)})
+    del history[:-20]
+
+    with st.sidebar.expander("Debug: timings and memory"):
+        if not st.checkbox("Show stage timings", key='debug_panel'):
+            return
+        import pandas as pd
+
+        mb = lambda value: None if value is None else round(value / 1024 ** 2, 1)
+        st.dataframe(pd.DataFrame([{'stage': r.stage, 'seconds': round(r.seconds, 4), 'RSS (MB)': mb(r.rss_bytes),
+                                    'peak RSS (MB)': mb(r.peak_rss_bytes), 'traced peak (MB)': mb(r.traced_peak_bytes),
+                                    'allocated (MB)': mb(r.allocated_bytes)}
+                                   for r in recorder.records]), hide_index=True)
+        limit = session_memory_limit()
+        st.caption(f"Session holds {mb(session_held_bytes())} MB" + (f" of {mb(limit)} MB allowed" if limit else ""))
+        st.caption("Recent runs")
+        st.dataframe(pd.DataFrame(history[::-1]), hide_index=True)
+
+def remember_clustering(name, dataset_key, cube, model, num_clusters, streaming, budget_bytes,
+                        preprocessing, reduction, mean_spectra=None, counts=None, preview=None, spatial=NO_SPATIAL):
+    # The clustering on screen, for the session export; the mean spectra are computed on export if missing
+    st.session_state['clustering'] = {
+        'name': name, 'dataset_key': dataset_key, 'cube': cube, 'model': model, 'k': num_clusters,
+        'budget_bytes': budget_bytes, 'preprocessing': preprocessing,
+        'reduction': effective_reduction(reduction, streaming),
+        'method': clustering_method(streaming, budget_bytes, preview), 'spatial': spatial,
+        'mean_spectra': mean_spectra, 'counts': counts,
+    }
 
-    # Select a range of columns based on the start and end column labels
-    selected_columns = input_df.loc[:, start_column:end_column]
-
-    return selected_columns
+def session_from_clustering(clustering):
+    mean_spectra, counts = clustering['mean_spectra'], clustering['counts']
+    cube = clustering['cube']
+    if mean_spectra is None:
+        mean_spectra, counts = cluster_mean_spectra(cube.spectra, clustering['model'].labels, clustering['k'],
+                                                    block_pixels(cube, clustering['budget_bytes']))
+    model = clustering['model']
+    return Session(name=clustering['name'], dataset_key=clustering['dataset_key'], k=clustering['k'],
+                   labels=model.labels.reshape(cube.shape[:2]), centroids=model.centroids, inertia=model.inertia,
+                   mean_spectra=mean_spectra, counts=counts, xdata=cube.xdata,
+                   preprocessing=clustering['preprocessing'], reduction=clustering['reduction'],
+                   method=clustering['method'], layers=st.session_state.get('layers', []), spatial=clustering['spatial'])
+
+def settings_widget_values(preprocessing, reduction, spatial=NO_SPATIAL):
+    # Sidebar widget values that reproduce the given settings
+    baselines = {'none': "None", 'poly': "Polynomial", 'als': "ALS"}
+    methods = {'none': "None", 'svd': "Randomized SVD", 'incremental': "Incremental PCA"}
+    values = {'pp_crop': preprocessing.crop is not None, 'pp_despike': preprocessing.despike,
+              'pp_baseline': baselines[preprocessing.baseline], 'pp_poly_order': preprocessing.poly_order,
+              'pp_als_lambda': preprocessing.als_lambda, 'pp_als_p': preprocessing.als_p,
+              'pp_normalise': preprocessing.normalise.capitalize(), 'rd_method': methods[reduction.method],
+              'rd_target': "Explained variance" if reduction.variance > 0 else "Components",
+              'rd_components': reduction.components, 'sp_radius': spatial.radius, 'sp_weight': spatial.weight,
+              'sp_beta': spatial.beta, 'sp_min_size': spatial.min_size}
+    if preprocessing.crop is not None:
+        values['pp_crop_start'], values['pp_crop_end'] = preprocessing.crop
+    if reduction.variance > 0:
+        values['rd_variance'] = reduction.variance
+    return values
+
+def apply_pending_settings():
+    # Widget values can only be set before the widgets are drawn, so imports apply them on the next run
+    for key, value in st.session_state.pop('pending_settings', {}).items():
+        st.session_state[key] = value
+
+def load_session_file(uploaded_session):
+    # Arrays are memory-mapped from a directory that lives as long as the browser session
+    directory = tempfile.TemporaryDirectory(prefix='kmd_session_')
+    session = import_session(uploaded_session, directory.name)
+    st.session_state['session_dir'] = directory
+    st.session_state['imported_session'] = session
+    st.session_state['layers'] = list(session.layers)
+
+    # The fitted model goes back into the store, so re-uploading the WDF file does not refit either
+    settings = model_settings(session.preprocessing, session.reduction, session.spatial)
+    model = ClusterModel(labels=np.asarray(session.labels).ravel().astype(np.int32), centroids=np.asarray(session.centroids),
+                         inertia=session.inertia, n_iter=0)
+    get_model_store().put(session.dataset_key, session.k, model, settings, session.method)
+    st.session_state['pending_settings'] = settings_widget_values(session.preprocessing, session.reduction, session.spatial)
+
+def session_controls():
+    # Save the clustering and layers to a few-MB file, or pick up a saved one without the WDF file
+    with st.sidebar.expander("Session"):
+        clustering = st.session_state.get('clustering')
+        if clustering is not None:
+            if st.button("Prepare session file"):
+                buf = BytesIO()
+                with stage('export'):
+                    export_session(buf, session_from_clustering(clustering))
+                st.session_state['session_zip'] = (clustering['name'], buf.getvalue())
+            if 'session_zip' in st.session_state:
+                name, data = st.session_state['session_zip']
+                st.download_button(label=f"Download session ({len(data) / 1024 ** 2:.1f} MB)", data=data,
+                                   file_name=f"{os.path.splitext(name)[0]}_session.zip", key='download_session')
+
+        uploaded_session = st.file_uploader("Import session", type=["zip"], key='session_upload')
+        if uploaded_session is not None and st.session_state.get('session_file_id') != uploaded_session.file_id:
+            try:
+                with stage('import'):
+                    load_session_file(uploaded_session)
+            except ValueError as e:
+                st.error(f"Could not import the session: {e}")
+            else:
+                st.session_state['session_file_id'] = uploaded_session.file_id
+                st.rerun()
+
+        session = st.session_state.get('imported_session')
+        if session is not None:
+            st.caption(f"Imported: {session.name}, {session.k} clusters, {len(session.layers)} layers")
+
+def show_sweep_status(dataset_key, preprocessing=NO_PREPROCESSING, reduction=NO_REDUCTION, spatial=NO_SPATIAL):
+    # The sweep fits plain K-means on the features; label smoothing is applied to the chosen k only
+    state, lock = get_sweeps()
+    key = (dataset_key, model_settings(preprocessing, reduction, feature_settings(spatial)))
+    with lock:
+        retire_sweeps(state)
+        sweep = state['running'].get(key)
+        if isinstance(sweep, Future):
+            ks, scores, done = list(SWEEP_KS), {}, False
+        elif sweep is not None:
+            ks, scores, done = sweep.ks, dict(sweep.scores), False
+        elif key in state['finished']:
+            (ks, scores), done = state['finished'][key], True
+        else:
+            return
+
+    # Mark which slider values are already fitted
+    ready = sorted(scores)
+    st.caption("Precomputed: " + "  ".join(f"k={k} ✓" if k in ready else f"k={k} …" for k in ks))
+
+    if ready:
+        import pandas as pd
+
+        with st.expander("Choose k (elbow plot)"):
+            scores = pd.DataFrame([scores[k] for k in ready]).set_index('k')
+            st.line_chart(scores[['inertia']])
+            st.line_chart(scores[['silhouette']])
+    if not done:
+        st.button("Refresh precomputed k")
+
+
+
+@staged('interactive')
+def show_interactive_view(view_key, clusters_array, xdata, mean_spectra, cube=None, budget_bytes=None):
+    # Browser-side map and spectra: built once per clustering, then explored without reruns
+    cached = st.session_state.get('interactive_view')
+    if cached is None or cached[0] != view_key:
+        colours = ['#%02x%02x%02x' % tuple(int(c * 255 + 0.5) for c in rgb)
+                   for rgb in named_lut('viridis', len(mean_spectra))]
+        pixels = None
+        if cube is not None:
+            pixels = pixel_spectra_payload(cube.spectra, block_pixels=block_pixels(cube, budget_bytes or DEFAULT_BUDGET_BYTES))
+        html = interactive_view_html(clusters_array, xdata, mean_spectra, colours, pixels)
+        st.session_state['interactive_view'] = cached = (view_key, html, pixels is not None)
+        allocated(html)
+
+    # st.iframe replaces components.html in newer Streamlit releases
+    if hasattr(st, 'iframe'):
+        st.iframe(cached[1], height=480)
+    else:
+        import streamlit.components.v1 as components
+        components.html(cached[1], height=480)
+    if not cached[2]:
+        st.caption("Pixel spectra are not available for this map; hovering shows the cluster mean.")
       
 
 
@@ -75,43 +670,70 @@ def page1():
     
     st.write('''Observe the average spectrum for a specific cluster and alter the number of clusters.''')
 
+    streaming, budget_bytes = streaming_controls()
+    preprocessing = preprocessing_controls()
+    reduction = reduction_controls()
+    spatial = spatial_controls()
+
     
 
     # File Upload
     uploaded_file = st.file_uploader("Upload WDF File", type=["wdf"])
 
-    if uploaded_file is not None:
-        st.write("Uploaded file:", uploaded_file.name)
+    session = st.session_state.get('imported_session')
 
+    if uploaded_file is not None or session is not None:
         try:
-            # Read WDF file
-            with open(uploaded_file.name, 'wb') as f:
-                f.write(uploaded_file.read())
-            reader = WDFReader(uploaded_file.name)
-
-            # Get spectra and data matrix shape
-            spectra = reader.spectra
-            shp = spectra.shape
-
-            # Convert spectra to a NumPy array and reshape
-            data_matrix = spectra.reshape((shp[0] * shp[1], shp[2]))
-
-            # Get wavenumber range
-            wn = reader.xdata
-
-            # User input for the number of clusters
-            num_clusters = st.slider("Select the number of clusters:", min_value=2, max_value=10, value=4)
-
-            # Perform KMeans clustering
-            kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-            clusters = kmeans.fit_predict(data_matrix)
-
-            # Convert wn and spectra to DataFrames
-            wn_df = pd.DataFrame(wn, columns=['labels'])
-            spectra_df = pd.DataFrame(data_matrix, columns=[f'spectra_{i}' for i in range(shp[2])])
-
-            # Convert clusters to a NumPy array and reshape
-            clusters_array = clusters.reshape((shp[0], shp[1]))
+            if uploaded_file is not None:
+                st.write("Uploaded file:", uploaded_file.name)
+
+                # Read WDF file (parsed once per file content, shared by all pages)
+                dataset_key, cube = load_cube(uploaded_file, streaming or region_wanted())
+                dataset_key, cube, preview = select_region(dataset_key, cube)
+
+                # Get spectra and data matrix shape
+                spectra = cube.spectra
+                shp = cube.shape
+
+                # Get wavenumber range
+                wn = cube.xdata
+
+                # User input for the number of clusters
+                num_clusters = st.slider("Select the number of clusters:", min_value=2, max_value=10, value=4)
+
+                # Perform KMeans clustering (cached per dataset and k, precomputed in the background)
+                model = get_clusters(dataset_key, cube, num_clusters, streaming, budget_bytes, preprocessing, reduction,
+                                     preview, spatial)
+                clusters = model.labels
+                if not streaming:
+                    show_sweep_status(dataset_key, preprocessing, reduction, spatial)
+
+                # Mean spectrum of every cluster in one pass over the cube, a budget-sized block at a time
+                with stage('mean_spectra'):
+                    mean_spectra, counts = cluster_mean_spectra(spectra, clusters, num_clusters,
+                                                                block_pixels(cube, budget_bytes))
+                    allocated(mean_spectra, counts)
+
+                # Convert clusters to a NumPy array and reshape
+                clusters_array = clusters.reshape((shp[0], shp[1]))
+
+                remember_clustering(uploaded_file.name, dataset_key, cube, model, num_clusters, streaming, budget_bytes,
+                                    preprocessing, reduction, mean_spectra, counts, preview, spatial)
+            else:
+                # Imported session: labels and mean spectra as saved, no WDF parsing or clustering
+                st.write("Imported session:", session.name)
+                st.caption("Upload the WDF file to change the number of clusters or the settings.")
+                dataset_key, cube, num_clusters = session.dataset_key, None, session.k
+                wn, mean_spectra, clusters_array = session.xdata, session.mean_spectra, np.asarray(session.labels)
+                streaming, preprocessing, reduction = session.method != 'full', session.preprocessing, session.reduction
+                spatial = session.spatial
+                preview = None
+
+            # Interactive view: highlighting, comparing and hovering all happen in the browser
+            if st.checkbox("Interactive view", key='interactive'):
+                view_key = (dataset_key, num_clusters, streaming, preprocessing, reduction, spatial, preview is not None)
+                show_interactive_view(view_key, clusters_array, wn, mean_spectra, cube, budget_bytes)
+                return
 
             # User input for selected cluster
             selected_cluster = st.number_input("Enter the cluster number to highlight:", min_value=0, max_value=num_clusters-1, value=0)
@@ -120,28 +742,26 @@ def page1():
             if selected_cluster not in range(num_clusters):
                 st.error("Please enter a valid cluster number.")
 
-            # Plot the clusters array using plt.imshow()
-            fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(12, 5))
-
-            # Plot clusters_array
-            ax0.imshow(np.where(clusters_array == selected_cluster, 1, 0), cmap='Reds', interpolation='nearest', aspect='auto')
-            ax0.set_xlabel('x-length (μm)')
-            ax0.set_ylabel('y-length (μm)')
-            ax0.set_title('K-means map', fontsize=10)
-            ax0.grid(False)
+            col_map, col_plot = st.columns(2)
 
-            # Extract rows associated with the selected cluster
-            selected_rows = spectra_df.loc[clusters == selected_cluster]
+            # Map of the selected cluster, coloured with a lookup table instead of a matplotlib figure
+            with stage('render'):
+                col_map.image(highlight_map_image(clusters_array, selected_cluster), caption='K-means map',
+                              width='stretch')
 
             # Plot the average of the selected rows
-            ax1.plot(wn, selected_rows.mean(axis=0), label=f'Cluster {selected_cluster}', color='red')
+            plt = pyplot()
+            fig, ax1 = plt.subplots(figsize=(6, 5))
+            ax1.plot(wn, mean_spectra[selected_cluster], label=f'Cluster {selected_cluster}', color='red')
             ax1.set_xlabel('Wavenumber')
             ax1.set_ylabel('Average Intensity')
             ax1.set_title('Average Spectrum for Selected Cluster', fontsize=10)
             ax1.legend()
             ax1.grid(True)
 
-            st.write(fig)
+            with stage('plot'):
+                col_plot.write(fig)
+                plt.close(fig)
             
 
         except Exception as e:
@@ -160,41 +780,68 @@ def page2():
    
     """)
 
+    streaming, budget_bytes = streaming_controls()
+    preprocessing = preprocessing_controls()
+    reduction = reduction_controls()
+    spatial = spatial_controls()
+
     # File Upload
     uploaded_file = st.file_uploader("Upload WDF File", type=["wdf"])
 
-    if uploaded_file is not None:
-        st.write("Uploaded file:", uploaded_file.name)
+    session = st.session_state.get('imported_session')
 
+    if uploaded_file is not None or session is not None:
         try:
-            # Read WDF file
-            with open(uploaded_file.name, 'wb') as f:
-                f.write(uploaded_file.read())
-            reader = WDFReader(uploaded_file.name)
-
-            # Get spectra and data matrix shape
-            spectra = reader.spectra
-            shp = spectra.shape
-
-            # Convert spectra to a NumPy array and reshape
-            data_matrix = spectra.reshape((shp[0] * shp[1], shp[2]))
-
-            # Get wavenumber range
-            wn = reader.xdata
-
-            # User input for the number of clusters
-            num_clusters = st.slider("Select the number of clusters:", min_value=2, max_value=10, value=4)
-
-            # Perform KMeans clustering
-            kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-            clusters = kmeans.fit_predict(data_matrix)
-
-            # Convert wn and spectra to DataFrames
-            wn_df = pd.DataFrame(wn, columns=['labels'])
-            spectra_df = pd.DataFrame(data_matrix, columns=[f'spectra_{i}' for i in range(shp[2])])
-
-            # Convert clusters to a NumPy array and reshape
-            clusters_array = clusters.reshape((shp[0], shp[1]))
+            if uploaded_file is not None:
+                st.write("Uploaded file:", uploaded_file.name)
+
+                # Read WDF file (parsed once per file content, shared by all pages)
+                dataset_key, cube = load_cube(uploaded_file, streaming or region_wanted())
+                dataset_key, cube, preview = select_region(dataset_key, cube)
+
+                # Get spectra and data matrix shape
+                spectra = cube.spectra
+                shp = cube.shape
+
+                # Get wavenumber range
+                wn = cube.xdata
+
+                # User input for the number of clusters
+                num_clusters = st.slider("Select the number of clusters:", min_value=2, max_value=10, value=4)
+
+                # Perform KMeans clustering (cached per dataset and k, precomputed in the background)
+                model = get_clusters(dataset_key, cube, num_clusters, streaming, budget_bytes, preprocessing, reduction,
+                                     preview, spatial)
+                clusters = model.labels
+                if not streaming:
+                    show_sweep_status(dataset_key, preprocessing, reduction, spatial)
+
+                # Mean spectrum of every cluster in one pass over the cube, a budget-sized block at a time
+                with stage('mean_spectra'):
+                    mean_spectra, counts = cluster_mean_spectra(spectra, clusters, num_clusters,
+                                                                block_pixels(cube, budget_bytes))
+                    allocated(mean_spectra, counts)
+
+                # Convert clusters to a NumPy array and reshape
+                clusters_array = clusters.reshape((shp[0], shp[1]))
+
+                remember_clustering(uploaded_file.name, dataset_key, cube, model, num_clusters, streaming, budget_bytes,
+                                    preprocessing, reduction, mean_spectra, counts, preview, spatial)
+            else:
+                # Imported session: labels and mean spectra as saved, no WDF parsing or clustering
+                st.write("Imported session:", session.name)
+                st.caption("Upload the WDF file to change the number of clusters or the settings.")
+                dataset_key, cube, num_clusters = session.dataset_key, None, session.k
+                wn, mean_spectra, clusters_array = session.xdata, session.mean_spectra, np.asarray(session.labels)
+                streaming, preprocessing, reduction = session.method != 'full', session.preprocessing, session.reduction
+                spatial = session.spatial
+                preview = None
+
+            # Interactive view: highlighting, comparing and hovering all happen in the browser
+            if st.checkbox("Interactive view", key='interactive'):
+                view_key = (dataset_key, num_clusters, streaming, preprocessing, reduction, spatial, preview is not None)
+                show_interactive_view(view_key, clusters_array, wn, mean_spectra, cube, budget_bytes)
+                return
 
             # User input for selected cluster
             selected_cluster = st.number_input("Enter the cluster number to highlight:", min_value=0, max_value=num_clusters-1, value=0)
@@ -209,32 +856,28 @@ def page2():
             if selected_cluster2 not in range(num_clusters):
                 st.error("Please enter a valid cluster number.")
 
-            # Plot the clusters array using plt.imshow()
-            fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(15, 5))
-            
-
-            # Plot clusters_array
-            cax = ax0.imshow(clusters_array, aspect='equal')
-            ax0.set_xlabel('x-length (μm)')
-            ax0.set_ylabel('y-length (μm)')
-            ax0.set_title('K-means map (All Clusters)', fontsize=10)
-            fig.colorbar(cax, ax=ax0, orientation='vertical', fraction=0.046, pad=0.04)
-            ax0.grid(False)
+            col_map, col_key, col_plot = st.columns([5, 1, 6])
 
-            # Extract rows associated with the selected cluster
-            selected_rows = spectra_df.loc[clusters == selected_cluster]
-            selected_rows2 = spectra_df.loc[clusters == selected_cluster2]
+            # Map of all clusters and its key, coloured with a lookup table instead of a matplotlib figure
+            with stage('render'):
+                col_map.image(cluster_map_image(clusters_array, num_clusters), caption='K-means map (All Clusters)',
+                              width='stretch')
+                col_key.image(cluster_legend_image(num_clusters))
 
             # Plot the average of the selected rows
-            ax1.plot(wn, selected_rows.mean(axis=0), label=f'Cluster {selected_cluster}', color='red')
-            ax1.plot(wn, selected_rows2.mean(axis=0), label=f'Cluster {selected_cluster2}', color='blue')
+            plt = pyplot()
+            fig, ax1 = plt.subplots(figsize=(7.5, 5))
+            ax1.plot(wn, mean_spectra[selected_cluster], label=f'Cluster {selected_cluster}', color='red')
+            ax1.plot(wn, mean_spectra[selected_cluster2], label=f'Cluster {selected_cluster2}', color='blue')
             ax1.set_xlabel('Wavenumber')
             ax1.set_ylabel('Average Intensity')
             ax1.set_title('Cluster Average Spectrum Compare', fontsize=10)
             ax1.legend()
             ax1.grid(True)
 
-            st.write(fig)
+            with stage('plot'):
+                col_plot.write(fig)
+                plt.close(fig)
             
 
         except Exception as e:
@@ -251,6 +894,11 @@ def page3():
     spectral feature to the cluster.\n THe spectral feature intensity relating to colour intentisy). 
     """)
 
+    streaming, budget_bytes = streaming_controls()
+    preprocessing = preprocessing_controls()
+    reduction = reduction_controls()
+    spatial = spatial_controls()
+
 
 
     #Start = ''
@@ -268,161 +916,141 @@ def page3():
             if uploaded_file is not None:
                 
                 try:
-                # Read WDF file
-                    with open(uploaded_file.name, 'wb') as f:
-                        f.write(uploaded_file.read())
-                        reader = WDFReader(uploaded_file.name)
-
-                        # Get spectra and data matrix shape
-                        spectra = reader.spectra
-                        shp = spectra.shape
-
-                        # Convert spectra to a NumPy array and reshape
-                        data_matrix = spectra.reshape((shp[0] * shp[1], shp[2]))
-
-                        # Get wavenumber range
-                        w = reader.xdata
-                        wn = w.astype(float).astype(int)
-
-                        # User input for the number of clusters
-                        num_clusters = st.slider("Select the number of clusters:", min_value=2, max_value=10)
-                
-                        if num_clusters is not None:
-                            # Perform KMeans clustering
-                            kmeans = KMeans(n_clusters=num_clusters, random_state=0)
-                            clusters = kmeans.fit_predict(data_matrix)
-
-                            Clusters = pd.DataFrame(clusters).rename(columns={0:'labels'})
-
-                            # Convert wn and spectra to DataFrames
-                            spectra_df = pd.DataFrame(data_matrix, columns=wn)
-                            df = pd.concat([Clusters, spectra_df], axis=1).set_index(['labels'])
-
-                             # User input for selected cluster
-                            selected_cluster = st.number_input("Enter the cluster number to highlight:", min_value=0, max_value=num_clusters-1, value=0)
-                            #colour = st.text_input("Colour: ")
-
-                            # Check if the input is valid
-                            if selected_cluster not in range(num_clusters):
-                                st.error("Please enter a valid cluster number.")
-                            else:
-                                df1 = cluster_select(df, selected_cluster)
-                      
-                                df2 = select_range(df1, int(End), int(Start))
-                           
-
-                                st.write(df2.head(2))
-
-                                img_array = df2.values.mean(axis=1)
-
-                                img = img_array.reshape((shp[0],shp[1]))
-
-                                expanded_image = np.kron(img, np.ones((5, 5))) # Increases the resolution, each pixel becomes 25 (5 by 5)
-
-                                smoothed_expanded_image = gaussian_filter(expanded_image, sigma=2) # Blurs/interpolates the image
-
-                                
-                                def sum_values_at_coordinates(arr, coordinates):
-                                    return np.sum(arr[tuple(coordinates.T)])
-
-                                def find_changed_coordinates_and_sum(original_arr, new_arr):
-                                    changed_coords = np.argwhere((original_arr == 0) & (new_arr != 0))
-                                    total_sum = sum_values_at_coordinates(new_arr, changed_coords)
-                                    return changed_coords, total_sum
-
-                                def reset_pixels_below_median(arr, coordinates):
-                                    summed_values = np.array([arr[coord[0], coord[1]] for coord in coordinates])
-                                    thres_value = 3*np.mean(summed_values)
-                                    for coord in coordinates:
-                                        if arr[coord[0], coord[1]] < thres_value:
-                                            arr[coord[0], coord[1]] = 0
-                                            
-                                    return arr
-                                
-                                changed_coords, total_sum = find_changed_coordinates_and_sum(expanded_image, smoothed_expanded_image)
-                                
-
-
-                                SEI = reset_pixels_below_median(smoothed_expanded_image, changed_coords)
-
-                                
-
-
-                                
-                                colors_g = [(0, 0, 0), (0, 1, 0)]  # Green -> Black
-                                cmap_name_g = 'my_list'
-                                cmap_gb = LinearSegmentedColormap.from_list(cmap_name_g, colors_g, N=30)
-                                
-                                colors_r = [(0, 0, 0), (1, 0, 0)]  # Red -> Black
-                                cmap_name_r = 'my_list'
-                                cmap_rb = LinearSegmentedColormap.from_list(cmap_name_r, colors_r, N=30)
-
-                                colors_b = [(0, 0, 0), (0, 0, 1)]  # Blue -> Black
-                                cmap_name_b = 'my_list'
-                                cmap_bb = LinearSegmentedColormap.from_list(cmap_name_b, colors_b, N=30)
-
-                                colors_p = [(0, 0, 0), (0.7, 0, 0.7)]  # Purple -> Black
-                                cmap_name_p = 'my_list'
-                                cmap_pb = LinearSegmentedColormap.from_list(cmap_name_p, colors_p, N=30)
-
-                                # Dropdown menu with four color options
-                                selected_color = st.selectbox("Select a color:", ["Green", "Red", "Blue", "Purple"])
-
-                                # Create a dictionary mapping color names to their corresponding cmap
-                                cmap_mapping = {
-                                "Green": cmap_gb,
-                                "Red": cmap_rb,
-                                "Blue": cmap_bb,
-                                "Purple": cmap_pb
-                                }
+                    # Read WDF file (parsed once per file content, shared by all pages)
+                    dataset_key, cube = load_cube(uploaded_file, streaming or region_wanted())
+                    dataset_key, cube, preview = select_region(dataset_key, cube)
 
-                                # Get the selected colormap
-                                selected_cmap = cmap_mapping.get(selected_color, plt.cm.Greens)
+                    # Get spectra
+                    spectra = cube.spectra
 
+                    # Get wavenumber range, indexed for band look-ups in either axis direction
+                    index = WavenumberIndex(cube.xdata)
+                    band_range = parse_band_range(Start, End)
 
-                                # Plot the clusters array using plt.imshow()
-                                from mpl_toolkits.axes_grid1 import make_axes_locatable
-                                
-                                fig, ax0 = plt.subplots(figsize=(8, 6))
-                                divider = make_axes_locatable(ax0)
-                                cax = divider.append_axes('right', size='5%', pad=0.05)
-
-                                # Plot clusters_array with colorbar
-                                im = ax0.imshow(SEI, cmap=selected_cmap, aspect='auto')
-                                ax0.grid(False)
-                                ax0.axes.xaxis.set_visible(False)
-                                ax0.axes.yaxis.set_visible(False)
-                                fig.colorbar(im, cax=cax, orientation='vertical')
-                                
-
-                                st.write(fig)
-
-
-                                # Save the figure to a file
-                                name = st.text_input("Enter the filename (with extension):")
-                                #save_button = st.button("Save Figure")
-
-
-                                def download_button(plot, filename, button_text='Download Plot'):
-                                    # Save the plot to a BytesIO buffer
-                                    buf = BytesIO()
-                                    plot.savefig(buf, format='png')
-                                    buf.seek(0)
-
-                                    # Create a download button
-                                    st.download_button(label=button_text, data=buf, file_name=filename, key='download_button')
-
-                             
-
-                                
-       
-
-                                if len(name) > 0: 
-
-                                    # Call the download_button function
-                                    download_button(fig, name)
-                                                                      
-                                    st.success(f"Press the download button to save: {name}")
+                    # User input for the number of clusters
+                    num_clusters = st.slider("Select the number of clusters:", min_value=2, max_value=10)
+            
+                    if num_clusters is not None:
+                        # Perform KMeans clustering (cached per dataset and k, precomputed in the background)
+                        model = get_clusters(dataset_key, cube, num_clusters, streaming, budget_bytes, preprocessing,
+                                             reduction, preview, spatial)
+                        clusters = model.labels
+                        if not streaming:
+                            show_sweep_status(dataset_key, preprocessing, reduction, spatial)
+                        remember_clustering(uploaded_file.name, dataset_key, cube, model, num_clusters, streaming,
+                                            budget_bytes, preprocessing, reduction, preview=preview, spatial=spatial)
+
+                         # User input for selected cluster
+                        selected_cluster = st.number_input("Enter the cluster number to highlight:", min_value=0, max_value=num_clusters-1, value=0)
+                        #colour = st.text_input("Colour: ")
+
+                        # Band integration options
+                        col_method, col_baseline = st.columns(2)
+                        method = col_method.selectbox("Band integration:", ["Mean", "Trapezoid"])
+                        baseline = col_baseline.selectbox("Baseline:", ["None", "Linear"])
+
+                        # Post-processing of the layer image
+                        with st.expander("Layer post-processing"):
+                            upscale = st.number_input("Upscale factor:", min_value=1, max_value=20, value=5)
+                            sigma = st.number_input("Blur sigma:", min_value=0.0, value=2.0, step=0.5)
+                            threshold = st.number_input("Halo threshold (x mean halo intensity):", min_value=0.0, value=3.0, step=0.5)
+
+                        # Batch mode: every (cluster, range, colour) in an uploaded list, from this one clustering
+                        with st.expander("Batch mode: produce many layers at once"):
+                            spec_file = st.file_uploader("Layer list (CSV or JSON with cluster, start, end, colour)", type=["csv", "json"])
+                            if spec_file is not None:
+                                try:
+                                    specs = parse_layer_specs(spec_file.getvalue(), spec_file.name)
+                                    for spec in specs:
+                                        if spec.cluster not in range(num_clusters):
+                                            raise ValueError(f"Cluster {spec.cluster} does not exist for {num_clusters} clusters.")
+                                        if index.clip(spec.start, spec.end) is None:
+                                            raise ValueError(f"The range {spec.start:g}-{spec.end:g} lies outside the spectrum.")
+                                except ValueError as e:
+                                    st.error(f"Invalid layer list: {e}")
+                                else:
+                                    st.write(f"{len(specs)} layers listed.")
+                                    add_to_page4 = st.checkbox("Also add the layers to Page 4")
+                                    batch_key = ('layers', dataset_key, num_clusters, model_settings(preprocessing, reduction, spatial),
+                                                 clustering_method(streaming, budget_bytes, preview),
+                                                 tuple(specs), method, baseline, upscale, sigma, threshold)
+                                    if st.button("Generate layers"):
+                                        st.session_state['batch_request'] = batch_key
+                                    if st.session_state.get('batch_request') == batch_key:
+                                        # Generated in the background; the rest of the page stays usable meanwhile
+                                        batch_layers = run_job('layers', batch_key, generate_layers, spectra, clusters, index,
+                                                               specs, method.lower(), baseline.lower(), upscale, sigma, threshold,
+                                                               block_pixels(cube, budget_bytes), wait=False)
+                                        if batch_layers is not None:
+                                            del st.session_state['batch_request']
+                                            st.session_state['batch_zip'] = layers_zip(batch_layers)
+                                            if add_to_page4:
+                                                # Numbered on from the layers already added, so every name stays unique
+                                                added = st.session_state.setdefault('layers', [])
+                                                added.extend(renumber_layers(batch_layers, len(added) + 1))
+                                    if 'batch_zip' in st.session_state:
+                                        st.download_button(label='Download layers (ZIP)', data=st.session_state['batch_zip'],
+                                                           file_name='layers.zip', key='download_batch')
+
+                        # Check if the input is valid
+                        if selected_cluster not in range(num_clusters):
+                            st.error("Please enter a valid cluster number.")
+                        elif band_range is None:
+                            st.error("Please enter a numeric wavenumber range.")
+                        elif index.clip(*band_range) is None:
+                            st.error(f"The range lies outside the spectrum ({index.xdata.min():.0f}-{index.xdata.max():.0f}).")
+                        else:
+                            # Column offsets and interpolation weights for the band, found by binary search
+                            band, weights = index.band_weights(*band_range, method=method.lower(), baseline=baseline.lower())
+                            lo, hi = index.clip(*band_range)
+                            inside = index.channels(lo, hi)
+                            st.caption(f"Band: {lo:.1f}-{hi:.1f}, {inside.stop - inside.start} channels")
+
+                            # Band intensity per pixel, read straight from the cube and zeroed outside the cluster
+                            with stage('band_map'):
+                                img = band_intensity_map(spectra, clusters, selected_cluster, band, weights,
+                                                         block_pixels(cube, budget_bytes))
+                                allocated(img)
+
+                            # Upsample, blur and clear the blur halo around the cluster in one vectorized pass
+                            with stage('postprocess'):
+                                SEI = postprocess_layer(img, upscale=upscale, sigma=sigma, threshold=threshold)
+                                allocated(SEI)
+
+                            
+
+
+                            
+                            # Dropdown menu with four color options
+                            selected_color = st.selectbox("Select a color:", ["Green", "Red", "Blue", "Purple"])
+                            layer = Layer(name=layer_name(len(st.session_state.get('layers', [])) + 1, selected_cluster, lo, hi, selected_color),
+                                          image=SEI, colour=selected_color, vmin=float(SEI.min()), vmax=float(SEI.max()))
+
+                            # Layer image through the colour's lookup table, with its colour bar as a separate small image
+                            with stage('render'):
+                                map_png = encode_png(to_image(colourise(layer)))
+                                colourbar = colourbar_image(layer.colour, layer.vmin, layer.vmax, height=SEI.shape[0])
+                                colourbar_png = encode_png(colourbar)
+                                col_map, col_bar = st.columns([SEI.shape[1], colourbar.size[0]])
+                                col_map.image(map_png, width='stretch')
+                                col_bar.image(colourbar_png, width='stretch')
+
+                            # Keep the raw layer in the session so Page 4 can combine it without a PNG round trip
+                            if st.button("Add layer to Page 4"):
+                                st.session_state.setdefault('layers', []).append(layer)
+                                st.success(f"Added layer {layer.name}")
+
+
+                            # Save the map and its colour bar to files
+                            name = st.text_input("Enter the filename (with extension):")
+
+                            if len(name) > 0: 
+                                stem, extension = os.path.splitext(name)
+                                st.download_button(label='Download Plot', data=map_png, file_name=name, key='download_button')
+                                st.download_button(label='Download colour bar', data=colourbar_png,
+                                                   file_name=f"{stem}_colourbar{extension or '.png'}", key='download_colourbar')
+                                                                  
+                                st.success(f"Press the download button to save: {name}")
 
                 except Exception as e:
                     st.error(f"Error reading the WDF file: {e}")
@@ -440,185 +1068,201 @@ def page4():
     st.write("""
     The layers produced on the previous page can now be combined.\n
     
-    If there are more than two layers, repeat the process on the first combined map. 
+    Layers added on Page 3 are combined in a single step. Uploaded PNG images are combined two at a time:
+    if there are more than two, repeat the process on the first combined map. 
     """)
-    # Upload the first PNG image
-    uploaded_image1 = st.file_uploader("Choose the first PNG image", type=["png"])
 
-    # Upload the second PNG image
-    uploaded_image2 = st.file_uploader("Choose the second PNG image", type=["png"])
+    source = st.radio("Combine:", ["Layers from Page 3", "Uploaded PNG images"])
 
-    # Save the figure to a file
-    name1 = st.text_input("Enter the filename (with extension):")
+    if source == "Layers from Page 3":
+        layers = st.session_state.get('layers', [])
 
-    # Button to make black pixels in the first image transparent
-    make_transparent_button = st.button("Combine the images")
+        if len(layers) == 0:
+            st.info("No layers yet: use 'Add layer to Page 4' on Page 3.")
+        else:
+            # Choose the layers, their opacity and how they are blended (widgets keyed by position, not by name)
+            positions = list(range(len(layers)))
+            chosen = st.multiselect("Layers to combine:", positions, default=positions,
+                                    format_func=lambda i: layers[i].name)
+            blend_mode = st.selectbox("Blend mode:", ["Additive", "Max"])
+            alphas = [st.slider(f"Opacity of {layers[i].name}", min_value=0.0, max_value=1.0, value=1.0,
+                                key=f"alpha_{i}")
+                      for i in chosen]
 
-    
-
-    # Check if both images are uploaded and the button is pressed
-    if uploaded_image1 is not None and uploaded_image2 is not None and make_transparent_button is not None and len(name1) > 0:
-        # Convert the uploaded images to PIL Images
-        pil_image1 = Image.open(uploaded_image1).crop((101, 53, 687, 550))
-        pil_image2 = Image.open(uploaded_image2).crop((101, 53, 687, 550))
+            if st.button("Remove all layers"):
+                st.session_state['layers'] = []
+                st.rerun()
 
+            if len(chosen) > 0:
+                try:
+                    # Blend every chosen layer straight from its float array in one operation
+                    selected_layers = [layers[i] for i in chosen]
+                    with stage('composite'):
+                        combined = composite_layers(selected_layers, alphas, mode=blend_mode.lower())
+                        allocated(combined)
+                        final_image = to_image(combined)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    st.image([final_image], caption=["Combined Img"], width='stretch')
+
+                    # Save the figure to a file
+                    name1 = st.text_input("Enter the filename (with extension):")
+                    if len(name1) > 0:
+                        buf1 = BytesIO()
+                        final_image.save(buf1, 'png')
+                        st.download_button(label='Download Plot', data=buf1.getvalue(), file_name=name1, key='download_button')
+                        st.success(f"Press the download button to save: {name1}")
+
+    else:
+        # Upload the first PNG image
+        uploaded_image1 = st.file_uploader("Choose the first PNG image", type=["png"])
+
+        # Upload the second PNG image
+        uploaded_image2 = st.file_uploader("Choose the second PNG image", type=["png"])
+
+        # Near-black pixels (antialiased or compressed edges) can be made transparent too
+        tolerance = st.slider("Black tolerance:", min_value=0, max_value=64, value=0)
 
+        # Save the figure to a file
+        name1 = st.text_input("Enter the filename (with extension):")
 
-        # Function to make black pixels transparent
-        def make_black_pixels_transparent(input_image):
-            # Convert the image to RGBA mode
-            image_rgba = input_image.convert('RGBA')
+        # Button to make black pixels in the first image transparent
+        make_transparent_button = st.button("Combine the images")
 
-            # Get pixel data
-            pixeldata = list(image_rgba.getdata())
+    
 
-            # Make all black pixels transparent
-            for i, pixel in enumerate(pixeldata):
-                if pixel[:3] == (0, 0, 0):
-                    pixeldata[i] = (0, 0, 0, 0)  # Set alpha to 0 for black pixels
+        # Check if both images are uploaded and the button is pressed
+        if uploaded_image1 is not None and uploaded_image2 is not None and make_transparent_button is not None and len(name1) > 0:
+            # Convert the uploaded images to PIL Images (figures saved by the old page 3 are cropped to the map)
+            pil_image1 = crop_legacy(Image.open(uploaded_image1), LEGACY_FIGURE_SIZE, (101, 53, 687, 550))
+            pil_image2 = crop_legacy(Image.open(uploaded_image2), LEGACY_FIGURE_SIZE, (101, 53, 687, 550))
 
-            # Update the image with the modified pixel data
-            image_rgba.putdata(pixeldata)
 
-            return image_rgba
 
-        # Apply the function to the first image
-        transparent_image1 = make_black_pixels_transparent(pil_image1)
+            # Apply the function to the first image
+            with stage('transparency'):
+                transparent_image1 = make_black_pixels_transparent(pil_image1, tolerance)
 
 
 
-        def combine_images(background, foreground):
-            # Create a copy of the background image to avoid modifying the original
-            combined_image = background.copy()
+            def combine_images(background, foreground):
+                # Create a copy of the background image to avoid modifying the original
+                combined_image = background.copy()
 
-            # Paste the foreground image onto the combined image
-            combined_image.paste(foreground, (0, 0), foreground)
+                # Paste the foreground image onto the combined image
+                combined_image.paste(foreground, (0, 0), foreground)
 
-            return combined_image
+                return combined_image
 
-        # Overlay the transparent image on top of the non-transparent image
-        final_image = combine_images(pil_image2, transparent_image1)
+            # Overlay the transparent image on top of the non-transparent image
+            final_image = combine_images(pil_image2, transparent_image1)
 
 
 
-        # Display the final image
-        st.image([final_image], 
-                caption=["Combined Img"],
-                use_column_width=True)
+            # Display the final image
+            st.image([final_image], 
+                    caption=["Combined Img"],
+                    width='stretch')
 
     
-        def download_button2(plot1, filename1, button_text='Download Plot'):
-            # Save the plot to a BytesIO buffer
-            buf1 = BytesIO()
-            plot1.save(buf1, 'png')
-            buf1.seek(0)
-
-                                    # Create a download button
-            st.download_button(label=button_text, data=buf1, file_name=filename1, key='download_button')
+            def download_button2(plot1, filename1, button_text='Download Plot'):
+                # Save the plot to a BytesIO buffer
+                buf1 = BytesIO()
+                plot1.save(buf1, 'png')
+                buf1.seek(0)
+
+                                        # Create a download button
+                st.download_button(label=button_text, data=buf1, file_name=filename1, key='download_button')
                 
  
             
 
-        download_button2(final_image, name1)
-        st.success(f"Press the download button to save: {name1}")
-            
-
-def page5():
+            download_button2(final_image, name1)
+            st.success(f"Press the download button to save: {name1}")
 
 
-    st.markdown("Page 5: Add colour ranges")
-    st.sidebar.markdown("Page 5: Add colour ranges")
-
-    st.write("""
-    The combined map produced on the previous page now requires the \n
-    colour ranges to be added. 
-    """)
-    # Upload the first PNG image
-    uploaded_image3 = st.file_uploader("Choose map (PNG format)", type=["png"])
-
-    # Upload the second PNG image
-    uploaded_image4 = st.file_uploader("Choose the first colour range (PNG format)", type=["png"])
+def show_final_figure(figure_key, build):
+    # Compose the figure once per set of inputs; naming and downloading rerun the page without redrawing it
+    cached = st.session_state.get('final_figure')
+    if cached is None or cached[0] != figure_key:
+        with stage('figure'):
+            png = encode_png(build())
+        st.session_state['final_figure'] = cached = (figure_key, png)
 
-    # Upload the second PNG image
-    uploaded_image5 = st.file_uploader("Choose the second colour range (PNG format)", type=["png"])
+    # Display the final image
+    st.image([cached[1]], caption=["Final Img"], width='stretch')
 
-    # Upload the second PNG image
-    uploaded_image6 = st.file_uploader("Choose the third colour range (PNG format)", type=["png"])
-
-    # Button to make black pixels in the first image transparent
-    combine_button = st.button("Create final figure")
-
-
- 
-
-    # Check if both images are uploaded and the button is pressed
-    if uploaded_image3 is not None and uploaded_image4 is not None and uploaded_image5 is not None and uploaded_image6 is not None and combine_button:
-        # Convert the uploaded images to PIL Images
-        pil_image3 = Image.open(uploaded_image3).crop((1, 33, 585, 480))
-        pil_image4 = Image.open(uploaded_image4).crop((687, 53, 780, 550))
-        pil_image5 = Image.open(uploaded_image5).crop((687, 53, 780, 550))
-        pil_image6 = Image.open(uploaded_image6).crop((687, 53, 780, 550))
-
-        def combine_images(image1, image2, image3, image4):
-            # Get the sizes of each image
-            width3, height3 = pil_image3.size
-            width4, height4 = pil_image4.size
-            width5, height5 = pil_image5.size
-            width6, height6 = pil_image6.size
-
-            # Determine the size of the combined image
-            combined_width = width3 + width4 + width5 + width6 
-            combined_height = height4
-
-            # Create a new image with the determined size
-            combined_image = Image.new('RGB', (combined_width, combined_height))
-
-            # Paste each image onto the combined image
-            combined_image.paste(pil_image3, (0,0))
-            combined_image.paste(pil_image4, (width3 , 0))
-            combined_image.paste(pil_image5, (width3 + width4, 0))
-            combined_image.paste(pil_image6, (width3 + width4 + width5, 0))
-            
-            return combined_image
-
-
-        final_image2 = combine_images(pil_image3, pil_image4, pil_image5, pil_image6)
-
-        # Display the final image
-        st.image([final_image2], 
-                caption=["Final Img"],
-                use_column_width=True)
+    # Save the figure to a file
+    name2 = st.text_input("Enter the filename (with extension):", key='figure_name')
+    if len(name2) > 0:
+        st.download_button(label='Download Plot', data=cached[1], file_name=name2, key='download_button')
+        st.success(f"Press the download button to save: {name2}")
 
+def colour_range_controls(layers):
+    # Colour and value range of every colour bar; the defaults follow the layers made on Page 3
+    count = st.number_input("Number of colour ranges:", min_value=0, max_value=12, value=max(len(layers), 1))
+    colours = list(LAYER_COLOURS)
+    ranges = []
+    for number in range(int(count)):
+        layer = layers[number] if number < len(layers) else None
+        col_colour, col_min, col_max = st.columns(3)
+        colour = col_colour.selectbox(f"Colour {number + 1}", colours, key=f'range_colour_{number}',
+                                      index=colours.index(layer.colour) if layer else number % len(colours))
+        vmin = col_min.number_input("From", value=layer.vmin if layer else 0.0, key=f'range_min_{number}')
+        vmax = col_max.number_input("To", value=layer.vmax if layer else 1.0, key=f'range_max_{number}')
+        if vmax <= vmin:
+            raise ValueError(f"Colour range {number + 1}: 'To' must be greater than 'From'.")
+        ranges.append((colour, float(vmin), float(vmax)))
+    return ranges
 
-       
-        # Save the figure to a file
-        name2 = st.text_input("Enter the filename (with extension):")
-        #save_button = st.button("Save Figure")
-                                
-       
-
-        def download_button3(plot2, filename2, button_text='Download Plot'):
-            # Save the plot to a BytesIO buffer
-            buf2 = BytesIO()
-            plot2.save(buf2, 'png')
-            buf2.seek(0)
-
-            # Create a download button
-            st.download_button(label=button_text, data=buf2, file_name=filename2, key='download_button')
-                
- 
-            
+def page5():
 
-        download_button3(final_image2, name2)
-        st.success(f"Press the download button to save: {name2}")
 
-             
-                
-        
+    st.markdown("Page 5: Add colour ranges")
+    st.sidebar.markdown("Page 5: Add colour ranges")
 
-        
+    st.write("""
+    The combined map now requires the colour ranges to be added. \n
+    Colour bars are drawn from each layer's colours and value range, one per layer. 
+    """)
 
-        
+    layers = st.session_state.get('layers', [])
+    source = st.radio("Map:", ["Layers from Page 3", "Uploaded PNG image"], key='figure_source')
+
+    try:
+        if source == "Layers from Page 3":
+            if len(layers) == 0:
+                st.info("No layers yet: use 'Add layer to Page 4' on Page 3.")
+                return
+
+            # The same choices as Page 4; the figure is the composite plus a colour bar per chosen layer
+            positions = list(range(len(layers)))
+            chosen = st.multiselect("Layers to include:", positions, default=positions,
+                                    format_func=lambda i: layers[i].name)
+            blend_mode = st.selectbox("Blend mode:", ["Additive", "Max"], key='figure_blend')
+            alphas = [st.slider(f"Opacity of {layers[i].name}", min_value=0.0, max_value=1.0, value=1.0,
+                                key=f"figure_alpha_{i}")
+                      for i in chosen]
+            if len(chosen) == 0:
+                return
+
+            selected_layers = [layers[i] for i in chosen]
+            figure_key = ('layers', tuple(chosen), tuple((layer.name, layer.colour, layer.vmin, layer.vmax, layer.image.shape)
+                                          for layer in selected_layers), tuple(alphas), blend_mode)
+            show_final_figure(figure_key, lambda: layers_figure(selected_layers, alphas, blend_mode.lower()))
+        else:
+            # Upload the combined map (PNG images from the old Page 4 are cropped to the map as before)
+            uploaded_image3 = st.file_uploader("Choose map (PNG format)", type=["png"])
+            ranges = colour_range_controls(layers)
+            if uploaded_image3 is None:
+                return
+
+            figure_key = ('upload', uploaded_image3.file_id, tuple(ranges))
+            show_final_figure(figure_key, lambda: figure_image(
+                crop_legacy(Image.open(uploaded_image3), LEGACY_COMBINED_SIZE, (1, 33, 585, 480)), ranges))
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
 
 
 page_names_to_funcs = {  
@@ -633,5 +1277,14 @@ page_names_to_funcs = {
     "Page 5: Add colour ranges": page5,
     }
 
-selected_page = st.sidebar.selectbox("Select a page", page_names_to_funcs.keys())
-page_names_to_funcs[selected_page]()
+# Streamlit runs this file as __main__; importing it (e.g. from worker processes) draws nothing
+if __name__ == "__main__":
+    apply_pending_settings()
+    selected_page = st.sidebar.selectbox("Select a page", page_names_to_funcs.keys())
+    with recording(selected_page) as recorder:
+        with stage('page'):
+            page_names_to_funcs[selected_page]()
+        session_controls()
+    if INSTRUMENTED:
+        show_debug_panel(recorder)
+    start_prewarm()
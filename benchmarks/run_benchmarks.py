@@ -0,0 +1,211 @@
+"""Time every stage of the KMD pipeline on synthetic maps and write the results as JSON.
+
+    python benchmarks/run_benchmarks.py --sizes 50 100 200 --channels 1000 --out before.json
+    python benchmarks/run_benchmarks.py --sizes 50 100 200 --channels 1000 --compare before.json
+
+Each map size gets a synthetic WDF file with known cluster structure (see synthetic.py),
+which is then loaded, clustered and turned into layers the way page 3 does it. No
+Streamlit session or real WDF files are needed.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kmd_cluster import fit_kmeans, stream_kmeans
+from kmd_io import read_wdf_path, wdf_spectra_view
+from kmd_layers import (LAYER_COLOURS, LayerSpec, colourise, composite_layers, encode_png, generate_layers,
+                        postprocess_layer, to_image)
+from kmd_render import colourbar_image
+from kmd_spectra import WavenumberIndex, band_intensity_maps, cluster_mean_spectra
+from synthetic import write_wdf
+
+STAGES = ['load', 'load_view', 'reshape', 'kmeans', 'streaming', 'mean_spectra', 'band_maps', 'postprocess',
+          'render', 'render_png', 'composite']
+
+
+def timed(repeat, func, warmup=1):
+    # Best and median wall time of `repeat` calls after untimed warm-up calls (imports, caches)
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return {'best': min(times), 'median': float(np.median(times))}, result
+
+
+def render_figure(image, colour, vmin, vmax):
+    # The old page 3 matplotlib rendering of one layer (imshow, colourbar, PNG export), for comparison
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LinearSegmentedColormap
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+    cmap = LinearSegmentedColormap.from_list(colour, [(0, 0, 0), LAYER_COLOURS[colour]], N=30)
+    fig, ax = plt.subplots()
+    im = ax.imshow(image, cmap=cmap, vmin=vmin, vmax=vmax)
+    cax = make_axes_locatable(ax).append_axes("right", size="5%", pad=0.05)
+    fig.colorbar(im, cax=cax)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def adjusted_rand(truth, labels):
+    from sklearn.metrics import adjusted_rand_score
+    return float(adjusted_rand_score(truth.ravel(), labels))
+
+
+def benchmark_size(shape, k, noise, repeat, warmup, stages, workdir, stream_budget=8 << 20):
+    """Timings of every stage for one synthetic map, plus how well K-means found the clusters.
+
+    The streaming fit (with a memory budget of `stream_budget` bytes) is also scored
+    against the full fit, since both should find the same clusters.
+    """
+    path = os.path.join(workdir, f"map_{shape[0]}x{shape[1]}x{shape[2]}.wdf")
+    start = time.perf_counter()
+    xdata, truth = write_wdf(path, shape, k=k, noise=noise)
+    result = {'shape': list(shape), 'clusters': k, 'noise': noise, 'generate_s': time.perf_counter() - start,
+              'stages': {}}
+    stage_times = result['stages']
+
+    def run(name, func):
+        if name in stages:
+            stage_times[name], value = timed(repeat, func, warmup)
+            return value
+        return func()
+
+    cube = run('load', lambda: read_wdf_path(path))
+    run('load_view', lambda: wdf_spectra_view(path))
+    rows, cols, channels = cube.shape
+    data_matrix = run('reshape', lambda: cube.spectra.reshape((rows * cols, channels)))
+    model = run('kmeans', lambda: fit_kmeans(data_matrix, k))
+    result['adjusted_rand_index'] = adjusted_rand(truth, model.labels)
+    if 'streaming' in stages:
+        streamed = run('streaming', lambda: stream_kmeans(cube.spectra, k, stream_budget))
+        result['streaming_vs_full_ari'] = adjusted_rand(model.labels, streamed.labels)
+    run('mean_spectra', lambda: cluster_mean_spectra(cube.spectra, model.labels, k))
+
+    # One layer per cluster over the middle fifth of the axis, coloured in turn
+    index = WavenumberIndex(xdata)
+    lo, hi = float(xdata.min()), float(xdata.max())
+    centre, half = (lo + hi) / 2, (hi - lo) / 10
+    colours = list(LAYER_COLOURS)
+    specs = [LayerSpec(cluster=c, start=centre - half, end=centre + half, colour=colours[c % len(colours)])
+             for c in range(k)]
+    bands = [index.band_weights(spec.start, spec.end) for spec in specs]
+    maps = run('band_maps', lambda: band_intensity_maps(cube.spectra, model.labels, [s.cluster for s in specs], bands))
+    run('postprocess', lambda: [postprocess_layer(img) for img in maps])
+
+    layers = generate_layers(cube.spectra, model.labels, index, specs)
+    first = layers[0]
+    run('render', lambda: render_figure(first.image, first.colour, first.vmin, first.vmax))
+    run('render_png', lambda: (encode_png(to_image(colourise(first))),
+                               encode_png(colourbar_image(first.colour, first.vmin, first.vmax, first.image.shape[0]))))
+    run('composite', lambda: to_image(composite_layers(layers)))
+
+    os.remove(path)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    import sklearn
+    import scipy
+    return {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'sklearn': sklearn.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results, baseline):
+    # Ratio of every stage's best time to the same stage and shape in an earlier run, and
+    # any streaming-vs-full agreement that dropped
+    previous = {tuple(r['shape']): r for r in baseline['results']}
+    lines = []
+    for r in results['results']:
+        earlier = previous.get(tuple(r['shape']))
+        if earlier is None:
+            continue
+        if r.get('streaming_vs_full_ari', 1.0) < earlier.get('streaming_vs_full_ari', 0.0) - 0.01:
+            lines.append(f"{'x'.join(map(str, r['shape'])):>16} streaming ARI "
+                         f"{earlier['streaming_vs_full_ari']:.3f} -> {r['streaming_vs_full_ari']:.3f}  WORSE")
+        before = earlier['stages']
+        for stage, t in r['stages'].items():
+            if stage in before:
+                ratio = t['best'] / max(before[stage]['best'], 1e-9)
+                lines.append(f"{'x'.join(map(str, r['shape'])):>16} {stage:>13} "
+                             f"{before[stage]['best']:9.4f}s -> {t['best']:9.4f}s  x{ratio:.2f}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the KMD pipeline on synthetic Raman maps.")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[50, 100, 200],
+                        help="map sizes (N for an N x N map, default: 50 100 200)")
+    parser.add_argument('--channels', type=int, default=1000, help="spectral channels (default: 1000)")
+    parser.add_argument('-k', '--clusters', type=int, default=4, help="clusters in the synthetic maps (default: 4)")
+    parser.add_argument('--noise', type=float, default=3.0, help="noise standard deviation (default: 3)")
+    parser.add_argument('--stream-budget', type=float, default=8,
+                        help="memory budget of the streaming fit in MB (default: 8)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage (default: 3)")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed runs before timing (default: 1)")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="stages to time")
+    parser.add_argument('--out', help="JSON file for the results (default: print only)")
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    results = {'environment': environment(), 'results': []}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            result = benchmark_size((size, size, args.channels), args.clusters, args.noise, args.repeat,
+                                    args.warmup, set(args.stages), workdir, int(args.stream_budget * 2 ** 20))
+            results['results'].append(result)
+            timings = "  ".join(f"{stage} {t['best']:.4f}s" for stage, t in result['stages'].items())
+            quality = f"ARI {result['adjusted_rand_index']:.3f}"
+            if 'streaming_vs_full_ari' in result:
+                quality += f", streaming vs full {result['streaming_vs_full_ari']:.3f}"
+            print(f"{size}x{size}x{args.channels}: {timings}  ({quality})")
+
+    # Peak resident memory of the whole run (kilobytes on Linux, bytes on macOS; not on Windows)
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results['environment']['peak_rss_mb'] = peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(results, json.load(f)):
+                print(line)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Time how quickly a fresh process can serve the web app, and which heavy modules it loads.
+
+    python benchmarks/startup_benchmark.py --repeat 5 --budget 0.5 --out startup.json
+
+Every run starts a new interpreter, so nothing is cached between runs. Two things are
+timed: importing KMD_WebApp once Streamlit itself is imported (what the app adds to a
+replica's start), and drawing the home page in a Streamlit test session from scratch.
+The exit status is 1 when the median import time is over --budget seconds, so the
+script can guard cold starts in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from run_benchmarks import ROOT, environment
+
+# Dependencies that only some pages need; none of them should load with the home page
+HEAVY_MODULES = ['matplotlib', 'pandas', 'sklearn', 'scipy', 'renishawWiRE']
+
+CHILD = r'''
+import json, sys, time
+sys.path.insert(0, ROOT)
+start = time.perf_counter()
+import streamlit
+streamlit_s = time.perf_counter() - start
+if MODE == 'import':
+    start = time.perf_counter()
+    import KMD_WebApp
+    seconds = time.perf_counter() - start
+else:
+    from streamlit.testing.v1 import AppTest
+    start = time.perf_counter()
+    AppTest.from_file(ROOT + '/KMD_WebApp.py', default_timeout=120).run()
+    seconds = time.perf_counter() - start
+print(json.dumps({'streamlit_s': streamlit_s, 'seconds': seconds,
+                  'loaded': [m for m in HEAVY if m in sys.modules]}))
+'''
+
+
+def run_child(mode):
+    # One measurement in a new interpreter; KMD_PREWARM is cleared so nothing loads in the background
+    code = f"ROOT = {ROOT!r}\nMODE = {mode!r}\nHEAVY = {HEAVY_MODULES!r}\n" + CHILD
+    env = dict(os.environ, KMD_PREWARM='0')
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, env=env)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of the KMD web app.")
+    parser.add_argument('--repeat', type=int, default=5, help="fresh processes per measurement (default: 5)")
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help="allowed median seconds for importing the app (default: 0.5)")
+    parser.add_argument('--out', help="JSON file for the results (default: print only)")
+    args = parser.parse_args(argv)
+
+    results = {'environment': environment(), 'budget_s': args.budget}
+    for mode in ('import', 'home_page'):
+        runs = [run_child(mode) for _ in range(args.repeat)]
+        seconds = [r['seconds'] for r in runs]
+        results[mode] = {'best': min(seconds), 'median': statistics.median(seconds),
+                         'streamlit_median': statistics.median(r['streamlit_s'] for r in runs),
+                         'heavy_modules': runs[-1]['loaded']}
+        loaded = ", ".join(runs[-1]['loaded']) or "none"
+        print(f"{mode:>9}: median {results[mode]['median']:.3f}s, best {results[mode]['best']:.3f}s "
+              f"(streamlit import {results[mode]['streamlit_median']:.3f}s); heavy modules: {loaded}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if results['import']['median'] > args.budget:
+        print(f"Importing the app takes {results['import']['median']:.3f}s, over the {args.budget:.3f}s budget.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+import struct
+
+import numpy as np
+
+
+# Tasks - Synthetic Raman maps for the benchmarks
+
+
+def templates(xdata, k, rng):
+    # One spectrum per cluster: a flat background with two Lorentzian-like bands at random positions
+    lo, hi = float(xdata.min()), float(xdata.max())
+    spectra = []
+    for _ in range(k):
+        spectrum = np.full(len(xdata), 100.0)
+        for width, height in ((15, 50), (25, 30)):
+            centre = rng.uniform(lo + 0.1 * (hi - lo), hi - 0.1 * (hi - lo))
+            spectrum += height / (1 + ((xdata - centre) / width) ** 2)
+        spectra.append(spectrum)
+    return np.stack(spectra).astype(np.float32)
+
+
+def label_map(rows, cols, k, rng):
+    # Known cluster structure: Voronoi regions around 3k random seeds, each seed assigned a cluster
+    seeds = rng.uniform((0, 0), (rows, cols), size=(3 * k, 2))
+    seed_labels = np.concatenate([np.arange(k), rng.integers(0, k, 2 * k)])
+    yy, xx = np.mgrid[0:rows, 0:cols]
+    nearest = np.full((rows, cols), np.inf)
+    labels = np.zeros((rows, cols), dtype=np.int32)
+    for (y, x), label in zip(seeds, seed_labels):
+        dist = (yy - y) ** 2 + (xx - x) ** 2
+        closer = dist < nearest
+        nearest[closer] = dist[closer]
+        labels[closer] = label
+    return labels
+
+
+def synthetic_rows(shape, k=4, noise=3.0, seed=0, block_rows=64):
+    """Wavenumber axis, label map and a generator of (row offset, float32 block of spectra).
+
+    Spectra are the cluster template plus Gaussian noise of standard deviation `noise`;
+    they are produced a block of map rows at a time, so large maps never sit in memory.
+    """
+    rows, cols, channels = shape
+    rng = np.random.default_rng(seed)
+    xdata = np.linspace(1800, 400, channels).astype(np.float32)
+    spectra = templates(xdata, k, rng)
+    labels = label_map(rows, cols, k, rng)
+
+    def blocks():
+        block_rng = np.random.default_rng(seed + 1)
+        for start in range(0, rows, block_rows):
+            block_labels = labels[start:start + block_rows]
+            block = spectra[block_labels] + block_rng.normal(0, noise, block_labels.shape + (channels,))
+            yield start, block.astype(np.float32)
+
+    return xdata, labels, blocks()
+
+
+def synthetic_cube(shape, k=4, noise=3.0, seed=0):
+    # Whole (rows, columns, channels) cube in memory, with its wavenumber axis and label map
+    xdata, labels, blocks = synthetic_rows(shape, k, noise, seed)
+    cube = np.empty(shape, dtype=np.float32)
+    for start, block in blocks:
+        cube[start:start + len(block)] = block
+    return cube, xdata, labels
+
+
+def _block(name, payload_size, uid=0):
+    # WDF block header: name, uid and the size of the block including the header
+    return name.encode('ascii') + struct.pack('<iq', uid, 16 + payload_size)
+
+
+def write_wdf(path, shape, k=4, noise=3.0, seed=0):
+    """Write a synthetic map as a minimal WDF file that renishawWiRE and kmd_io can read.
+
+    The DATA block is written a block of rows at a time. Returns the wavenumber axis and
+    the true label map.
+    """
+    rows, cols, channels = shape
+    count = rows * cols
+    xdata, labels, blocks = synthetic_rows(shape, k, noise, seed)
+
+    # WDF1 header: measurement info at 0x3C, application name and version, laser wavenumber
+    header = bytearray(0x200 - 16)
+    def put(offset, fmt, *values):
+        struct.pack_into(fmt, header, offset - 16, *values)
+    put(0x3C, '<iqqiiii', channels, count, count, 1, 1, channels, 2)
+    header[0x3C + 20:0x3C + 44] = b'WiRE'.ljust(24, b'\0')
+    put(0x3C + 60, '<hhhhii', 5, 0, 0, 0, 3, 3)
+    put(0x98, '<if', 1, 12738.85)
+
+    with open(path, 'wb') as f:
+        f.write(_block('WDF1', len(header), uid=1) + header)
+
+        f.write(_block('DATA', count * channels * 4))
+        for _, block in blocks:
+            f.write(block.astype('<f4').tobytes())
+
+        f.write(_block('YLST', 12) + struct.pack('<ii', 0, 0) + np.zeros(1, '<f4').tobytes())
+        f.write(_block('XLST', 8 + channels * 4) + struct.pack('<ii', 1, 1) + xdata.astype('<f4').tobytes())
+
+        # Stage positions of every spectrum (x and y in micrometres)
+        yy, xx = np.mgrid[0:rows, 0:cols]
+        origins = struct.pack('<i', 2)
+        for data_type, positions in ((3, xx), (4, yy)):
+            origins += (struct.pack('<Ii', data_type | (1 << 31), 5) + b'pos'.ljust(16, b'\0')
+                        + positions.ravel().astype('<f8').tobytes())
+        f.write(_block('ORGN', len(origins)) + origins)
+
+        wmap = struct.pack('<ii', 0, 0) + struct.pack('<6f', 0, 0, 0, 1, 1, 0) + struct.pack('<ii', cols, rows) + b'\0' * 8
+        f.write(_block('WMAP', len(wmap)) + wmap)
+
+    return xdata, labels
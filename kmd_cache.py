@@ -0,0 +1,242 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+
+# Tasks - Caching helpers shared by the pages
+
+
+class LoadCancelled(Exception):
+    """Raised by a loader that gave up; threads waiting for the same key then load it themselves."""
+
+
+def nbytes_of(value):
+    # Approximate memory held by a cached value: the sum of its array buffers. Memory-mapped
+    # arrays (e.g. streaming scratch cubes) live in their files, so they count nothing
+    if isinstance(value, np.ndarray) and maps_file(value):
+        return 0
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(nbytes_of(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes_of(v) for v in value)
+    return 0
+
+
+def maps_file(value):
+    # True when a value holds memory-mapped arrays, which are views of files rather than data to copy
+    if isinstance(value, np.ndarray):
+        # Reshaped and sliced views of a memmap are plain arrays whose base chain leads to it
+        while isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+            value = value.base
+        return isinstance(value, np.memmap)
+    if isinstance(value, dict):
+        return any(maps_file(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return any(maps_file(v) for v in value)
+    return False
+
+
+class DiskCache:
+    """Pickled values in a directory shared by every process on the server, bounded by total file size.
+
+    Files are written under a temporary name and renamed into place, so other processes
+    never read a partial file, and the least recently used files are removed beyond
+    max_bytes. Loading unpickles the files: use a directory only the server can write to.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        # Keys are tuples of strings, numbers and settings namedtuples, whose repr is stable
+        name = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            # Unreadable or written by an incompatible version: drop it and load afresh
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        # Best effort: values too large, memory-mapped ones and write errors are simply not stored
+        if value is None or maps_file(value) or nbytes_of(value) > self.max_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            self._remove(tmp)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ByteLRUCache:
+    """Thread-safe least-recently-used mapping bounded by the size of its values.
+
+    An optional DiskCache behind it keeps loaded values across restarts and server processes.
+    """
+
+    def __init__(self, max_bytes, sizeof=nbytes_of, disk=None):
+        self.max_bytes = int(max_bytes)
+        self.total_bytes = 0
+        self.disk = disk
+        self._sizeof = sizeof
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def keys(self):
+        with self._lock:
+            return list(self._items.keys())
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        # Read from the disk tier outside the lock, then keep the value in memory as well
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                return self._keep(key, value)
+        return default
+
+    def put(self, key, value):
+        if self.disk is not None:
+            self.disk.put(key, value)
+        return self._keep(key, value)
+
+    def _keep(self, key, value):
+        size = self._sizeof(value)
+
+        with self._lock:
+            self.discard(key)
+
+            # A value larger than the whole budget is returned to the caller but never kept
+            if size > self.max_bytes:
+                return value
+
+            # Evict the least recently used entries until the new value fits
+            while self._items and self.total_bytes + size > self.max_bytes:
+                self.discard(next(iter(self._items)))
+
+            self._items[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._items:
+                del self._items[key]
+                self.total_bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def get_or_load(self, key, loader):
+        """Cached value for key, loaded at most once however many threads ask for it together.
+
+        Loading happens outside the lock so a slow parse does not block other keys. Threads
+        asking for a key that is already loading wait for that load and share its result
+        (or its exception) instead of repeating the work; if that load was cancelled, the
+        next waiting thread loads the key itself.
+        """
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+            with self._lock:
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    return self._items[key]
+                loading = self._loading.get(key)
+                future = None
+                if loading is None:
+                    future = Future()
+                    self._loading[key] = (future, threading.get_ident())
+
+            # The loader asking for its own key loads again rather than waiting on itself
+            if loading is None or loading[1] == threading.get_ident():
+                break
+            try:
+                return loading[0].result()
+            except LoadCancelled:
+                continue
+
+        try:
+            value = self.put(key, loader())
+        except BaseException as e:
+            if future is not None:
+                future.set_exception(e)
+            raise
+        else:
+            if future is not None:
+                future.set_result(value)
+        finally:
+            if future is not None:
+                with self._lock:
+                    self._loading.pop(key, None)
+        return value
@@ -0,0 +1,146 @@
+"""Batch K-means decomposition of WDF maps without the web app.
+
+    python kmd_cli.py maps/*.wdf --out results --clusters 4 --layers layers.csv
+
+Every input file (or every .wdf file in an input directory) is processed in its own
+worker process and gets a results folder named after it: labels.npy, mean_spectra.csv,
+layer_NN.png, composite.png, figure.png (the composite with its colour bars) and
+summary.json, plus session.zip with --session (opened through "Import session" in the
+web app). The layer list uses the same CSV/JSON format as the batch generator on page 3.
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from kmd_layers import parse_layer_specs
+from kmd_pipeline import process_file
+from kmd_preprocess import Preprocessing
+from kmd_reduce import Reduction
+from kmd_spatial import Spatial
+
+
+def find_inputs(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.wdf'))))
+        else:
+            files.append(path)
+    return files
+
+
+def _process(path, out_dir, threads, options):
+    # Worker process: share the cores between the files instead of oversubscribing them
+    from threadpoolctl import threadpool_limits
+
+    with threadpool_limits(limits=threads):
+        return process_file(path, out_dir, workers=threads, **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="K-means decomposition of Raman maps in WDF files.")
+    parser.add_argument('inputs', nargs='+', help="WDF files or directories containing them")
+    parser.add_argument('--out', default='kmd_results', help="output directory (default: kmd_results)")
+    parser.add_argument('-k', '--clusters', type=int, default=4, help="number of clusters (default: 4)")
+    parser.add_argument('--layers', help="CSV or JSON layer list with cluster, start, end, colour")
+    parser.add_argument('--method', choices=['mean', 'trapezoid'], default='mean', help="band integration")
+    parser.add_argument('--baseline', choices=['none', 'linear'], default='none', help="band baseline")
+    parser.add_argument('--upscale', type=int, default=5)
+    parser.add_argument('--sigma', type=float, default=2.0)
+    parser.add_argument('--threshold', type=float, default=3.0)
+    parser.add_argument('--blend', choices=['additive', 'max'], default='additive', help="composite blend mode")
+    parser.add_argument('--crop', nargs=2, type=float, metavar=('START', 'END'), help="cluster on this region only")
+    parser.add_argument('--despike', type=float, default=0.0, help="cosmic-ray z-score threshold (default: off)")
+    parser.add_argument('--background', choices=['none', 'poly', 'als'], default='none',
+                        help="baseline removed before clustering")
+    parser.add_argument('--poly-order', type=int, default=3)
+    parser.add_argument('--als-lambda', type=float, default=1e5)
+    parser.add_argument('--als-p', type=float, default=0.01)
+    parser.add_argument('--normalise', choices=['none', 'vector', 'area'], default='none',
+                        help="normalisation before clustering")
+    parser.add_argument('--reduce', choices=['none', 'svd', 'incremental'], default='none',
+                        help="cluster on principal-component scores (default: none)")
+    parser.add_argument('--components', type=int, default=20, help="components kept, or the limit with --variance")
+    parser.add_argument('--variance', type=float, default=0.0, help="fraction of the variance to keep")
+    parser.add_argument('--neighbourhood', type=int, default=0, metavar='RADIUS',
+                        help="blend each spectrum with its neighbourhood mean before clustering (default: 0, off)")
+    parser.add_argument('--neighbour-weight', type=float, default=0.5, help="share of the neighbourhood mean")
+    parser.add_argument('--smoothing', type=float, default=0.0, metavar='BETA',
+                        help="Potts label smoothing strength after clustering (default: 0, off)")
+    parser.add_argument('--min-region', type=int, default=0, metavar='PIXELS',
+                        help="merge connected regions smaller than this into their surroundings (default: 0, off)")
+    parser.add_argument('--session', action='store_true', help="also write session.zip for the web app's import")
+    parser.add_argument('--preview', type=int, default=1, metavar='N',
+                        help="fit on every Nth row and column, then assign every pixel (default: 1, off)")
+    parser.add_argument('--streaming', action='store_true', help="cluster large maps within --budget-mb")
+    parser.add_argument('--budget-mb', type=int, default=256, help="memory budget per file (default: 256)")
+    parser.add_argument('-j', '--jobs', type=int, default=0, help="parallel files (default: one per core)")
+    args = parser.parse_args(argv)
+
+    files = find_inputs(args.inputs)
+    if not files:
+        parser.error("no WDF files found")
+    if args.clusters < 2:
+        parser.error("--clusters must be at least 2")
+    if args.preview < 1:
+        parser.error("--preview must be at least 1")
+    if args.neighbourhood < 0 or not 0 <= args.neighbour_weight <= 1:
+        parser.error("--neighbourhood must not be negative and --neighbour-weight must lie between 0 and 1")
+
+    specs = []
+    if args.layers:
+        with open(args.layers, 'rb') as f:
+            try:
+                specs = parse_layer_specs(f.read(), args.layers)
+            except ValueError as e:
+                parser.error(f"{args.layers}: {e}")
+
+    options = dict(k=args.clusters, specs=specs, streaming=args.streaming, budget_bytes=args.budget_mb << 20,
+                   method=args.method, baseline=args.baseline, upscale=args.upscale, sigma=args.sigma,
+                   threshold=args.threshold, blend=args.blend, session=args.session, preview_step=args.preview,
+                   preprocessing=Preprocessing(crop=tuple(args.crop) if args.crop else None, despike=args.despike,
+                                               baseline=args.background, poly_order=args.poly_order,
+                                               als_lambda=args.als_lambda, als_p=args.als_p,
+                                               normalise=args.normalise),
+                   reduction=Reduction(method=args.reduce, components=args.components, variance=args.variance),
+                   spatial=Spatial(radius=args.neighbourhood, weight=args.neighbour_weight, beta=args.smoothing,
+                                   min_size=args.min_region))
+
+    # Result folders are named after the files; the same name in two directories gets a suffix
+    out_dirs, used = {}, set()
+    for path in files:
+        name = base = os.path.splitext(os.path.basename(path))[0]
+        number = 1
+        while name in used:
+            number += 1
+            name = f"{base}_{number}"
+        used.add(name)
+        out_dirs[path] = os.path.join(args.out, name)
+
+    cores = os.cpu_count() or 1
+    jobs = min(len(files), args.jobs or cores)
+    threads = max(1, cores // jobs)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(_process, path, out_dirs[path], threads, options): path for path in files}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"{path}: failed: {e}", file=sys.stderr)
+            else:
+                rows, cols, channels = summary['shape']
+                print(f"{path}: {rows}x{cols} map, {channels} channels, {len(summary['layers'])} layers"
+                      f" -> {out_dirs[path]}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
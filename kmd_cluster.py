@@ -0,0 +1,346 @@
+import os
+import tempfile
+import threading
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+
+from kmd_cache import ByteLRUCache
+from kmd_spectra import cluster_sums
+
+
+# Tasks - Clustering section
+
+
+# Result of one K-means fit: a label per pixel plus the fitted centroids
+ClusterModel = namedtuple('ClusterModel', ['labels', 'centroids', 'inertia', 'n_iter'])
+
+# Quality of the fit for one k, used for the elbow plot
+SweepScore = namedtuple('SweepScore', ['k', 'inertia', 'silhouette'])
+
+# Range offered by the number-of-clusters slider
+SWEEP_KS = range(2, 11)
+
+
+# Lloyd iterations between progress reports of a fit with a progress callback
+CHUNK_ITERATIONS = 25
+MAX_ITERATIONS = 300
+
+# k-means++ seedings tried on the pixel samples that warm starts and streaming fits start from
+SAMPLE_SEEDINGS = 10
+
+
+def fit_kmeans(data_matrix, k, init=None, progress=None, n_init='auto'):
+    """K-means fit of the rows of data_matrix, seeded with k-means++ or the given centroids.
+
+    Without `init`, the best of `n_init` k-means++ seedings is kept (sklearn's 'auto' is one).
+
+    With `progress`, the Lloyd iterations run CHUNK_ITERATIONS at a time, each chunk
+    starting from the centroids the last one reached, and `progress(iterations, maximum)`
+    is called in between (it may raise to abandon the fit).
+    """
+    from sklearn.cluster import KMeans
+
+    def kmeans_from(centroids, max_iter=MAX_ITERATIONS):
+        if centroids is None:
+            return KMeans(n_clusters=k, n_init=n_init, random_state=0, max_iter=max_iter)
+        return KMeans(n_clusters=k, init=centroids, n_init=1, random_state=0, max_iter=max_iter)
+
+    if progress is None:
+        kmeans = kmeans_from(init)
+        labels = kmeans.fit_predict(data_matrix)
+        return ClusterModel(labels=labels, centroids=kmeans.cluster_centers_,
+                            inertia=float(kmeans.inertia_), n_iter=int(kmeans.n_iter_))
+
+    n_iter, centroids = 0, init
+    while True:
+        step = min(CHUNK_ITERATIONS, MAX_ITERATIONS - n_iter)
+        kmeans = kmeans_from(centroids, step)
+        labels = kmeans.fit_predict(data_matrix)
+        n_iter += int(kmeans.n_iter_)
+        centroids = kmeans.cluster_centers_
+        progress(n_iter, MAX_ITERATIONS)
+        # Fewer iterations than allowed means the chunk converged
+        if kmeans.n_iter_ < step or n_iter >= MAX_ITERATIONS:
+            break
+
+    return ClusterModel(labels=labels, centroids=centroids, inertia=float(kmeans.inertia_), n_iter=n_iter)
+
+
+def warm_start_centroids(data_matrix, model, k, sample_size=10000):
+    """Initial centroids for k clusters derived from a model fitted with a different k.
+
+    The old model's clusters can be a worse start than a cold fit (e.g. two true clusters
+    merged at a smaller k), so on a pixel sample the warm start is compared with a
+    k-means++ fit, and the cold fit's centroids are used when they fit the sample better.
+    """
+    centroids = model.centroids
+    if len(centroids) == k:
+        return centroids
+
+    rng = np.random.default_rng(0)
+    n = data_matrix.shape[0]
+    sample = np.asarray(data_matrix[np.sort(rng.choice(n, size=min(n, sample_size), replace=False))])
+    warm = merge_centroids(model, k) if len(centroids) > k else seed_extra_centroids(sample, centroids, k, rng)
+
+    cold = fit_kmeans(sample, k, n_init=SAMPLE_SEEDINGS)
+    if fit_kmeans(sample, k, init=warm).inertia <= cold.inertia:
+        return warm
+    return cold.centroids.astype(centroids.dtype)
+
+
+def merge_centroids(model, k):
+    # Fewer clusters: merge the old centroids, weighted by how many pixels each one holds
+    from sklearn.cluster import KMeans
+
+    counts = np.bincount(model.labels, minlength=len(model.centroids))
+    merge = KMeans(n_clusters=k, n_init=1, random_state=0).fit(model.centroids, sample_weight=counts)
+    return merge.cluster_centers_.astype(model.centroids.dtype)
+
+
+def seed_extra_centroids(sample, centroids, k, rng):
+    # More clusters: keep the old centroids and seed the extra ones from a sample with greedy
+    # k-means++, which like sklearn draws several candidates per centre and keeps the one
+    # that lowers the inertia most (a single draw often lands inside an existing cluster)
+    sq_norms = (sample ** 2).sum(axis=1)
+    dist = (sq_norms[:, None] - 2 * sample @ centroids.T + (centroids ** 2).sum(axis=1)).min(axis=1)
+    dist = np.maximum(dist, 0).astype(np.float64)
+    trials = 2 + int(np.log(k))
+
+    seeds = [centroids]
+    for _ in range(k - len(centroids)):
+        if dist.sum() > 0:
+            candidates = rng.choice(len(sample), size=trials, p=dist / dist.sum())
+        else:
+            candidates = rng.integers(len(sample), size=trials)
+        to_candidates = np.maximum(sq_norms[candidates][:, None] - 2 * sample[candidates] @ sample.T + sq_norms, 0)
+        best = np.minimum(dist, to_candidates).sum(axis=1).argmin()
+        seeds.append(sample[candidates[best]][None, :])
+        dist = np.minimum(dist, to_candidates[best])
+
+    return np.concatenate(seeds).astype(centroids.dtype)
+
+
+class ModelStore:
+    """Fitted K-means models keyed by (dataset, k, preprocessing), bounded by memory size."""
+
+    def __init__(self, max_bytes, disk=None):
+        self._cache = ByteLRUCache(max_bytes, disk=disk)
+
+    def get(self, dataset_key, k, preprocessing=(), method='full'):
+        return self._cache.get((dataset_key, int(k), preprocessing, method))
+
+    def put(self, dataset_key, k, model, preprocessing=(), method='full'):
+        return self._cache.put((dataset_key, int(k), preprocessing, method), model)
+
+    def fitted_ks(self, dataset_key, preprocessing=(), method='full'):
+        return sorted(key[1] for key in self._cache.keys()
+                      if key[0] == dataset_key and key[2] == preprocessing and key[3] == method)
+
+    def nearest(self, dataset_key, k, preprocessing=()):
+        # Cached model whose k is closest to the requested one (smaller k wins a tie)
+        ks = self.fitted_ks(dataset_key, preprocessing)
+        if not ks:
+            return None
+        nearest_k = min(ks, key=lambda other: (abs(other - k), other))
+        return self.get(dataset_key, nearest_k, preprocessing)
+
+    def get_or_fit(self, dataset_key, data_matrix, k, preprocessing=(), progress=None):
+        # Sessions asking for the same model at the same time share one fit
+        def fit():
+            nearest = self.nearest(dataset_key, k, preprocessing)
+            init = None if nearest is None else warm_start_centroids(data_matrix, nearest, k)
+            return fit_kmeans(data_matrix, k, init=init, progress=progress)
+
+        return self._cache.get_or_load((dataset_key, int(k), preprocessing, 'full'), fit)
+
+    def get_or_stream(self, dataset_key, spectra, k, budget_bytes, preprocessing=(), progress=None):
+        # The budget sets the sample and block sizes, so it is part of the key
+        method = ('streaming', budget_bytes)
+        return self._cache.get_or_load((dataset_key, int(k), preprocessing, method),
+                                       lambda: stream_kmeans(spectra, k, budget_bytes, progress=progress))
+
+
+# Tasks - Streaming (low-memory) clustering
+
+
+def rows_per_block(shape, budget_bytes):
+    # Map rows whose float32 spectra (plus working copies) fit in the memory budget
+    rows, cols, channels = shape
+    row_bytes = cols * channels * 4 * 3
+    return int(min(rows, max(1, budget_bytes // row_bytes)))
+
+
+def iter_row_blocks(spectra, block_rows):
+    # Pixel offset and (pixels, channels) float32 copy of each block of map rows
+    rows, cols, channels = spectra.shape
+    for start in range(0, rows, block_rows):
+        block = spectra[start:start + block_rows]
+        yield start * cols, np.ascontiguousarray(block.reshape(-1, channels), dtype=np.float32)
+
+
+def stream_kmeans(spectra, k, budget_bytes, n_passes=2, progress=None):
+    """K-means over a (rows, columns, channels) cube read a block of rows at a time.
+
+    Peak memory follows `budget_bytes` rather than the map size: centroids are seeded
+    from a pixel sample that fits the budget, then refined with up to `n_passes` exact
+    Lloyd passes over the blocks, and a last pass labels every pixel. The returned
+    centroids are the exact means of the final clusters. `progress(done, total)` is
+    called after every block read.
+    """
+    rows, cols, channels = spectra.shape
+    n = rows * cols
+    block_rows = rows_per_block(spectra.shape, budget_bytes)
+    n_blocks = -(-rows // block_rows)
+    total_steps = (n_passes + 1) * n_blocks
+
+    # Seed from pixels spread over the whole map, not just the first rows. The sample is
+    # small, so several seedings are tried: the passes below only refine the best one
+    sample_size = int(min(n, max(k, budget_bytes // (channels * 4 * 3))))
+    sample_idx = np.unique(np.linspace(0, n - 1, sample_size).astype(np.int64))
+    sample_rows, sample_cols = np.divmod(sample_idx, cols)
+    sample = np.asarray(spectra[sample_rows, sample_cols], dtype=np.float32)
+    centroids = fit_kmeans(sample, k, n_init=SAMPLE_SEEDINGS).centroids
+    del sample
+
+    # Each pass labels every pixel and accumulates the cluster sums, so it is one Lloyd
+    # iteration; unlike mini-batch updates it cannot drift on the row-ordered blocks
+    model = None
+    for number in range(n_passes + 1):
+        passing = None
+        if progress is not None:
+            passing = lambda done, total, first=number * n_blocks: progress(first + done, total_steps)
+        previous, model = model, assign_clusters(spectra, centroids, budget_bytes, progress=passing)
+        if previous is not None and np.array_equal(previous.labels, model.labels):
+            break
+        centroids = model.centroids
+
+    return model._replace(n_iter=number)
+
+
+def assign_clusters(spectra, centroids, budget_bytes, transform=None, progress=None):
+    """ClusterModel labelling every pixel of a cube with its nearest centroid, a block of rows at a time.
+
+    `transform` maps each float32 (pixels, channels) block into the space the centroids
+    live in (e.g. preprocessing and projection onto components). The returned centroids
+    are the exact means of the final clusters in that space, the inertia is measured
+    there, and `progress(done, total)` is called after every block.
+    """
+    rows, cols, channels = spectra.shape
+    block_rows = rows_per_block(spectra.shape, budget_bytes)
+    n_blocks = -(-rows // block_rows)
+    centroids = np.asarray(centroids, dtype=np.float32)
+    k = len(centroids)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+
+    labels = np.empty(rows * cols, dtype=np.int32)
+    sums = np.zeros(centroids.shape, dtype=np.float64)
+    inertia = 0.0
+    for number, (offset, block) in enumerate(iter_row_blocks(spectra, block_rows), start=1):
+        if transform is not None:
+            block = np.asarray(transform(block), dtype=np.float32)
+        distances = centroid_norms - 2 * block @ centroids.T
+        block_labels = distances.argmin(axis=1).astype(np.int32)
+        labels[offset:offset + len(block)] = block_labels
+        sums += cluster_sums(block, block_labels, k)
+        inertia += float(((block - centroids[block_labels]) ** 2).sum())
+        if progress is not None:
+            progress(number, n_blocks)
+
+    # Clusters that received no pixel keep their centroid
+    counts = np.bincount(labels, minlength=k)
+    means = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+
+    return ClusterModel(labels=labels, centroids=means.astype(np.float32), inertia=inertia, n_iter=0)
+
+
+def _sweep_fit(path, k, threads):
+    # Worker process: fit one k on the memory-mapped data matrix and score it
+    from sklearn.metrics import silhouette_score
+    from threadpoolctl import threadpool_limits
+
+    data_matrix = np.load(path, mmap_mode='r')
+    with threadpool_limits(limits=threads):
+        model = fit_kmeans(data_matrix, k)
+        silhouette = silhouette_score(data_matrix, model.labels,
+                                      sample_size=min(len(model.labels), 5000), random_state=0)
+
+    return model, float(silhouette)
+
+
+class ClusterSweep:
+    """Fits every k of a dataset on a process pool, filling a ModelStore as results arrive."""
+
+    def __init__(self, executor, store, dataset_key, data_matrix, ks=SWEEP_KS, preprocessing=()):
+        self.ks = list(ks)
+        self.scores = {}
+        self.errors = {}
+        self._store = store
+        self._dataset_key = dataset_key
+        self._preprocessing = preprocessing
+        self._lock = threading.Lock()
+        self._pending = len(self.ks)
+
+        # Workers memory-map one copy of the matrix instead of each receiving a pickled copy
+        fd, self._path = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        np.save(self._path, data_matrix)
+
+        # Split the cores between the fits so the whole sweep takes about as long as one fit
+        threads = max(1, (os.cpu_count() or 1) // len(self.ks))
+        self._futures = {}
+        try:
+            for k in self.ks:
+                self._futures[k] = executor.submit(_sweep_fit, self._path, k, threads)
+        except BaseException:
+            # E.g. BrokenProcessPool: nothing will finish to clean up the matrix file
+            for future in self._futures.values():
+                future.cancel()
+            os.remove(self._path)
+            raise
+        for k, future in self._futures.items():
+            future.add_done_callback(partial(self._finished, k))
+
+    def _finished(self, k, future):
+        try:
+            model, silhouette = future.result()
+        except BaseException as e:
+            self.errors[k] = e
+        else:
+            # A model the user is already looking at is kept, so its cluster numbers do not change
+            if self._store.get(self._dataset_key, k, self._preprocessing) is None:
+                self._store.put(self._dataset_key, k, model, self._preprocessing)
+            self.scores[k] = SweepScore(k=k, inertia=model.inertia, silhouette=silhouette)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if self._pending == 0:
+                    os.remove(self._path)
+
+    def ready(self):
+        return sorted(self.scores)
+
+    def done(self):
+        return self._pending == 0
+
+    def result(self, k, timeout=None):
+        # Block until the fit for k has finished; None when k is not part of the sweep or failed
+        future = self._futures.get(k)
+        if future is None:
+            return None
+        try:
+            model, silhouette = future.result(timeout=timeout)
+        except BaseException:
+            return None
+        return model
+
+    def pending(self, k):
+        # True while the fit for k is queued or running
+        future = self._futures.get(k)
+        return future is not None and not future.done()
+
+    def cancel(self):
+        # Fits that have not started yet are dropped; running ones finish
+        for future in self._futures.values():
+            future.cancel()
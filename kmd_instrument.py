@@ -0,0 +1,198 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# Tasks - Per-stage timing and memory instrumentation
+#
+# KMD_INSTRUMENT=0 switches everything off, 1 (the default) records wall time and RSS,
+# 'tracemalloc' also records the peak of traced allocations (slower). Every stage is logged
+# as one JSON line at INFO level on the 'kmd.instrument' logger, which writes them to stderr
+# (not through the root logger, which has no handler under Streamlit); KMD_INSTRUMENT_LOG
+# names a file that receives the lines as well.
+#
+# Stages also report the bytes of the arrays they allocate, as declared with allocated().
+# Unlike RSS this is per session, so it is what a per-session memory ceiling compares to.
+
+
+MODE = os.environ.get('KMD_INSTRUMENT', '1').strip().lower()
+ENABLED = MODE not in ('0', 'false', 'off', 'no', '')
+TRACEMALLOC = MODE == 'tracemalloc'
+
+logger = logging.getLogger('kmd.instrument')
+if ENABLED:
+    # Python's last-resort handler only prints WARNING and above, so the records get their own
+    # handlers, and do not also reach any root handler a front end configures
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    _handlers = [logging.StreamHandler()]
+    if os.environ.get('KMD_INSTRUMENT_LOG'):
+        _handlers.append(logging.FileHandler(os.environ['KMD_INSTRUMENT_LOG']))
+    for _handler in _handlers:
+        _handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(_handler)
+
+# One measured stage; memory figures are None where the platform cannot report them
+StageRecord = namedtuple('StageRecord', ['stage', 'seconds', 'rss_bytes', 'peak_rss_bytes', 'traced_peak_bytes',
+                                         'allocated_bytes'])
+
+
+def current_rss():
+    # Resident set size of this process in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def array_bytes(value):
+    """Bytes of memory a value's arrays hold themselves, recursing into tuples, lists and dicts.
+
+    Views of another array's part, of memory-mapped files and of bytes objects (e.g. an
+    upload viewed in place) count nothing; a reshaped view of a whole array counts in full.
+    """
+    if isinstance(value, np.ndarray):
+        base = value
+        while isinstance(base.base, np.ndarray):
+            base = base.base
+        if isinstance(base, np.memmap) or base.base is not None or base.nbytes != value.nbytes:
+            return 0
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(array_bytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(array_bytes(v) for v in value)
+    return 0
+
+
+def peak_rss():
+    # Highest resident set size of this process so far in bytes (kilobytes on Linux, bytes on macOS)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Recorder:
+    """Stages measured during one page run, in the order they finished.
+
+    Nested stages are recorded as 'outer/inner'. The RSS figures are process wide, so
+    with several sessions running at once they include the other sessions' work.
+    """
+
+    def __init__(self, run_name):
+        self.run_name = run_name
+        self.started = time.time()
+        self.records = []
+        self._stack = []
+        self._peaks = []
+        self._allocated = []
+
+    @contextmanager
+    def stage(self, name):
+        traced = None
+        if TRACEMALLOC:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # The enclosing stage keeps the peak reached so far, since the inner stage restarts it
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(name)
+        self._peaks.append(0)
+        self._allocated.append(0)
+        path = '/'.join(self._stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            peak = self._peaks.pop()
+            allocated = self._allocated.pop()
+            if self._allocated:
+                self._allocated[-1] += allocated
+            if TRACEMALLOC:
+                traced = max(peak, tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], traced)
+            record = StageRecord(stage=path, seconds=seconds, rss_bytes=current_rss(),
+                                 peak_rss_bytes=peak_rss(), traced_peak_bytes=traced, allocated_bytes=allocated)
+            self.records.append(record)
+            logger.info(json.dumps({'run': self.run_name, 'started': self.started, **record._asdict()}))
+
+    def allocate(self, nbytes):
+        # Count bytes against the innermost running stage (and, when it ends, its parents)
+        if self._allocated:
+            self._allocated[-1] += nbytes
+
+    def total_seconds(self):
+        # Wall time of the top-level stages
+        return sum(r.seconds for r in self.records if '/' not in r.stage)
+
+
+_current = contextvars.ContextVar('kmd_recorder', default=None)
+
+
+@contextmanager
+def recording(run_name):
+    """Make a new Recorder the current one for the duration of a page run; yields it (None when off)."""
+    if not ENABLED:
+        yield None
+        return
+    recorder = Recorder(run_name)
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name):
+    # Measure the enclosed block as a stage of the current run; does nothing outside a run
+    recorder = _current.get()
+    if recorder is None:
+        yield
+        return
+    with recorder.stage(name):
+        yield
+
+
+def allocated(*values):
+    # Report the arrays a stage has just created; returns the byte count, and works outside a run too
+    nbytes = array_bytes(values)
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.allocate(nbytes)
+    return nbytes
+
+
+def staged(name):
+    # Decorator form of stage() for helper functions
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
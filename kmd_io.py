@@ -0,0 +1,128 @@
+import hashlib
+import os
+import struct
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+
+# Tasks - WDF loading section
+
+
+# Spectra stay float32 from the file to the layers; nothing in the pipeline widens them
+SPECTRA_DTYPE = np.float32
+
+# Parsed map: spectra cube (rows, columns, wavenumbers), wavenumber axis and cube shape
+Cube = namedtuple('Cube', ['spectra', 'xdata', 'shape'])
+
+# Part of a map: (start, stop) row and column ranges (None for all) and a sampling step
+Region = namedtuple('Region', ['rows', 'cols', 'step'], defaults=[None, None, 1])
+
+
+def content_hash(data):
+    # Key a file by its contents rather than its name
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_hash(path, chunk_bytes=1 << 20):
+    # content_hash of a file on disk, read a chunk at a time
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def region_view(cube, region):
+    """Cube of the region's pixels, every `step`-th row and column, as a view of the spectra.
+
+    Nothing is copied: on a memory-mapped cube only the selected pixels are read when the
+    view is used.
+    """
+    rows = region.rows or (0, cube.shape[0])
+    cols = region.cols or (0, cube.shape[1])
+    if rows[1] - rows[0] < 1 or cols[1] - cols[0] < 1:
+        raise ValueError("The region contains no pixels.")
+    spectra = cube.spectra[rows[0]:rows[1]:region.step, cols[0]:cols[1]:region.step]
+    return Cube(spectra=spectra, xdata=cube.xdata, shape=spectra.shape)
+
+
+def cube_from_reader(reader):
+    # renishawWiRE already reads float32, so this is normally no copy
+    spectra = np.asarray(reader.spectra, dtype=SPECTRA_DTYPE)
+    if spectra.ndim != 3:
+        raise ValueError("The WDF file does not contain a 2D map.")
+
+    return Cube(spectra=spectra, xdata=reader.xdata, shape=spectra.shape)
+
+
+def read_wdf_path(path):
+    from renishawWiRE import WDFReader
+
+    reader = WDFReader(path)
+    reader.close()
+    return cube_from_reader(reader)
+
+
+def read_wdf_bytes(data):
+    # WDFReader needs a path, so give it a private temporary file instead of the working directory
+    fd, path = tempfile.mkstemp(suffix='.wdf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return read_wdf_path(path)
+    finally:
+        os.remove(path)
+
+
+# Block layout of WDF files (the same offsets renishawWiRE uses)
+BLOCK_HEADER = 0x10
+MEASUREMENT_INFO = 0x3C
+WMAP_SHAPE = 0x30
+
+
+def _wdf_blocks(buf):
+    # Map of block name -> (offset, size) found by walking the block headers
+    blocks = {}
+    pos = 0
+    while pos + BLOCK_HEADER <= len(buf):
+        name = bytes(buf[pos:pos + 4])
+        size = struct.unpack_from('<q', buf, pos + 8)[0]
+        if size < BLOCK_HEADER:
+            break
+        blocks.setdefault(name.decode('ascii', 'replace'), (pos, size))
+        pos += size
+    return blocks
+
+
+def wdf_spectra_view(source):
+    """Cube whose spectra are read straight from the WDF DATA block without decoding.
+
+    `source` is either the file contents (bytes, viewed without copying) or a path,
+    which is memory-mapped so that only the rows actually used are read from disk.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        buf = source
+    else:
+        buf = np.memmap(source, dtype=np.uint8, mode='r')
+
+    blocks = _wdf_blocks(buf)
+    for name in ('WDF1', 'DATA', 'XLST', 'WMAP'):
+        if name not in blocks:
+            raise ValueError(f"The WDF file has no {name} block.")
+
+    point_per_spectrum, capacity, count = struct.unpack_from('<iqq', buf, MEASUREMENT_INFO)
+    width, height = struct.unpack_from('<ii', buf, blocks['WMAP'][0] + WMAP_SHAPE)
+    if width * height != count or height < 2 or width < 2:
+        raise ValueError("The WDF file does not contain a complete 2D map.")
+
+    # XLST holds a type and a unit ahead of the wavenumber axis
+    xdata = np.frombuffer(buf, dtype='<f4', count=point_per_spectrum,
+                          offset=blocks['XLST'][0] + BLOCK_HEADER + 8).copy()
+
+    data = np.frombuffer(buf, dtype='<f4', count=count * point_per_spectrum,
+                         offset=blocks['DATA'][0] + BLOCK_HEADER)
+    spectra = data.reshape((height, width, point_per_spectrum))
+
+    return Cube(spectra=spectra, xdata=xdata, shape=spectra.shape)
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from kmd_cache import LoadCancelled
+
+
+# Tasks - Background jobs with progress and cancellation
+#
+# Long computations run on an executor instead of inside the page script. The work reports
+# progress through a callback, which is also where a cancelled job stops: the callback
+# raises JobCancelled, so cancellation takes effect at the next reported step.
+
+
+class JobCancelled(LoadCancelled):
+    """Raised inside a job's work when the job has been cancelled.
+
+    Other jobs waiting in a shared cache for something the cancelled job was loading
+    then load it themselves.
+    """
+
+
+class Job:
+    """One background computation, shared by every session waiting for the same key."""
+
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self.owners = set()
+        self.started = time.time()
+        self.done_steps = 0
+        self.total_steps = None
+        self.message = ''
+        self._cancelled = threading.Event()
+
+    def progress(self, done=None, total=None, message=None):
+        # Progress callback handed to the work; raises JobCancelled once the job is cancelled
+        if self._cancelled.is_set():
+            raise JobCancelled(self.key)
+        if message is not None:
+            self.message = message
+        if total is not None:
+            self.total_steps = total
+        if done is not None:
+            self.done_steps = done
+
+    def fraction(self):
+        if not self.total_steps:
+            return 0.0
+        return min(1.0, self.done_steps / self.total_steps)
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def result(self):
+        # The work's return value; raises its exception (JobCancelled for a cancelled job)
+        if self.future.cancelled():
+            raise JobCancelled(self.key)
+        return self.future.result()
+
+
+class JobBoard:
+    """Running jobs keyed by what they compute, so identical requests share one job.
+
+    Each job remembers which owners (sessions) wait for it. An owner that moves on
+    releases its job, and a job nobody waits for any more is cancelled. Finished jobs
+    leave the board; their results are kept by the caller (e.g. in a ModelStore).
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, owner, func, *args, **kwargs):
+        # `func` is called with the job's progress callback as the keyword argument `progress`
+        started = None
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.cancelled():
+                job = started = Job(key)
+                self._jobs[key] = job
+                job.future = self._executor.submit(self._run, job, func, args, kwargs)
+            job.owners.add(owner)
+
+        # Outside the lock: a job that has already finished runs the callback right here
+        if started is not None:
+            started.future.add_done_callback(lambda future, job=started: self._finished(job))
+        return job
+
+    @staticmethod
+    def _run(job, func, args, kwargs):
+        job.progress()
+        return func(*args, progress=job.progress, **kwargs)
+
+    def _finished(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def release(self, key, owner):
+        # The owner no longer waits for the job; cancel it if nobody else does
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            job.owners.discard(owner)
+            if not job.owners and not job.done():
+                job.cancel()
+                del self._jobs[key]
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
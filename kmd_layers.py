@@ -0,0 +1,213 @@
+import csv
+import io
+import json
+import os
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+from kmd_spectra import band_intensity_maps
+
+
+# Tasks - Layer image processing
+
+
+# Layer colours: each colormap runs from black to the colour in COLORMAP_STEPS steps
+LAYER_COLOURS = {
+    "Green": (0, 1, 0),
+    "Red": (1, 0, 0),
+    "Blue": (0, 0, 1),
+    "Purple": (0.7, 0, 0.7),
+}
+COLORMAP_STEPS = 30
+
+# Float layer image from page 3 with the colour and value range it is drawn with
+Layer = namedtuple('Layer', ['name', 'image', 'colour', 'vmin', 'vmax'])
+
+# One requested layer of a batch: cluster, wavenumber range and colour
+LayerSpec = namedtuple('LayerSpec', ['cluster', 'start', 'end', 'colour'])
+
+
+def layer_name(number, cluster, start, end, colour):
+    return f"{number}: cluster {cluster}, {start:.0f}-{end:.0f}, {colour}"
+
+
+def renumber_layers(layers, first):
+    # The layers with their names numbered on from `first`, for adding a batch to an existing list
+    return [layer._replace(name=f"{number}: {layer.name.split(': ', 1)[-1]}")
+            for number, layer in enumerate(layers, start=first)]
+
+
+def postprocess_layer(img, upscale=5, sigma=2, threshold=3):
+    """Upsampled and blurred layer with the faint blur halo around the cluster removed.
+
+    Each pixel becomes an `upscale` x `upscale` block, the result is Gaussian blurred with
+    `sigma`, and pixels the blur spread into from outside the cluster are zeroed unless they
+    reach `threshold` times the mean of that halo.
+    """
+    from scipy.ndimage import gaussian_filter, zoom
+
+    # The upsampled image is upscale**2 times the map, so it is kept in float32
+    img = np.asarray(img, dtype=np.float32)
+
+    # Nearest-neighbour upsampling gives the same blocks as np.kron with a block of ones
+    smoothed = zoom(img, upscale, order=0, grid_mode=True, mode='nearest')
+    outside = np.repeat(np.repeat(img == 0, upscale, axis=0), upscale, axis=1)
+
+    # The blur works line by line, so it can write over its own input
+    gaussian_filter(smoothed, sigma=sigma, output=smoothed)
+
+    # Pixels outside the cluster that the blur spread into
+    halo = outside & (smoothed != 0)
+    if halo.any():
+        smoothed[halo & (smoothed < threshold * smoothed[halo].mean())] = 0
+
+    return smoothed
+
+
+def make_black_pixels_transparent(input_image, tolerance=0):
+    # Pixels whose red, green and blue are all at most `tolerance` become fully transparent
+    pixels = np.array(input_image.convert('RGBA'))
+    pixels[pixels[..., :3].max(axis=-1) <= tolerance] = 0
+
+    return Image.fromarray(pixels)
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(colour, steps=COLORMAP_STEPS):
+    # (steps, 3) RGB table of the black -> colour LinearSegmentedColormap page 3 draws with, built once
+    rgb = np.asarray(LAYER_COLOURS.get(colour, colour), dtype=np.float32)
+    lut = np.linspace(0, 1, steps, dtype=np.float32)[:, None] * rgb[None, :]
+    lut.flags.writeable = False
+    return lut
+
+
+def colormap_indices(image, vmin, vmax, steps=COLORMAP_STEPS):
+    # Colormap entry of every pixel, binned the way matplotlib's imshow bins a linear norm
+    if vmax > vmin:
+        scaled = (image - vmin) * (steps / (vmax - vmin))
+    else:
+        scaled = np.zeros(image.shape, dtype=np.float32)
+    return np.clip(scaled, 0, steps - 1).astype(np.intp)
+
+
+def colourise(layer, alpha=1.0):
+    # (rows, columns, 3) float RGB of a layer, scaled by its opacity
+    lut = colormap_lut(layer.colour) * np.float32(alpha)
+    return lut[colormap_indices(layer.image, layer.vmin, layer.vmax)]
+
+
+def composite_layers(layers, alphas=None, mode='additive'):
+    """Blend any number of same-sized layers into one RGB image.
+
+    'additive' sums the coloured layers (clipped to white), 'max' keeps the brightest value
+    of each channel. Opacities are folded into each layer's lookup table, so every layer
+    costs one table lookup and one in-place blend.
+    """
+    if not layers:
+        raise ValueError("No layers to combine.")
+    shapes = {layer.image.shape for layer in layers}
+    if len(shapes) > 1:
+        raise ValueError("The layers have different sizes and cannot be combined.")
+    if alphas is None:
+        alphas = [1.0] * len(layers)
+
+    combined = np.zeros(layers[0].image.shape + (3,), dtype=np.float32)
+    for layer, alpha in zip(layers, alphas):
+        if mode == 'additive':
+            combined += colourise(layer, alpha)
+        elif mode == 'max':
+            np.maximum(combined, colourise(layer, alpha), out=combined)
+        else:
+            raise ValueError(f"Unknown blend mode: {mode}")
+
+    return np.clip(combined, 0, 1, out=combined)
+
+
+def to_image(rgb):
+    # 8-bit PIL image of a float RGB array in [0, 1]
+    return Image.fromarray((rgb * 255 + 0.5).astype(np.uint8))
+
+
+# Tasks - Batch layer generation
+
+
+def parse_layer_specs(data, filename):
+    """Layer specs from a CSV (header: cluster,start,end,colour) or a JSON list of objects."""
+    text = data.decode('utf-8-sig') if isinstance(data, bytes) else data
+    if filename.lower().endswith('.json'):
+        rows = json.loads(text)
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+
+    specs = []
+    for number, row in enumerate(rows, start=1):
+        row = {str(key).strip().lower(): value for key, value in row.items()}
+        try:
+            colour = str(row.get('colour', row.get('color', 'Green'))).strip().capitalize()
+            spec = LayerSpec(cluster=int(row['cluster']), start=float(row['start']),
+                             end=float(row['end']), colour=colour)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Row {number} needs numeric cluster, start and end values.")
+        if spec.colour not in LAYER_COLOURS:
+            raise ValueError(f"Row {number}: colour must be one of {', '.join(LAYER_COLOURS)}.")
+        specs.append(spec)
+
+    return specs
+
+
+def generate_layers(spectra, labels, index, specs, method='mean', baseline='none',
+                    upscale=5, sigma=2, threshold=3, block_pixels=8192, workers=None, progress=None):
+    """Finished layers for every spec from one clustering and one pass over the cube.
+
+    The band maps are computed together; the upsample/blur/threshold stage then runs on a
+    thread pool (SciPy releases the GIL while filtering). `progress(done, total)` counts
+    the band pass as one step and every finished layer as another.
+    """
+    bands = [index.band_weights(spec.start, spec.end, method=method, baseline=baseline) for spec in specs]
+    maps = band_intensity_maps(spectra, labels, [spec.cluster for spec in specs], bands, block_pixels)
+    if progress is not None:
+        progress(1, len(specs) + 1)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        images = []
+        for image in pool.map(lambda img: postprocess_layer(img, upscale, sigma, threshold), maps):
+            images.append(image)
+            if progress is not None:
+                progress(len(images) + 1, len(specs) + 1)
+
+    layers = []
+    for number, (spec, image) in enumerate(zip(specs, images), start=1):
+        lo, hi = index.clip(spec.start, spec.end)
+        layers.append(Layer(name=layer_name(number, spec.cluster, lo, hi, spec.colour), image=image,
+                            colour=spec.colour, vmin=float(image.min()), vmax=float(image.max())))
+    return layers
+
+
+def encode_png(image):
+    buf = io.BytesIO()
+    image.save(buf, 'png')
+    return buf.getvalue()
+
+
+def layers_zip(layers, workers=None):
+    """ZIP of one PNG per layer plus a manifest of names, colours and value ranges."""
+    # PNG compression releases the GIL, so the layers are encoded in parallel
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        pngs = list(pool.map(lambda layer: encode_png(to_image(colourise(layer))), layers))
+
+    manifest = []
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as archive:
+        for number, (layer, png) in enumerate(zip(layers, pngs), start=1):
+            filename = f"layer_{number:02d}.png"
+            archive.writestr(filename, png)
+            manifest.append({'file': filename, 'name': layer.name, 'colour': layer.colour,
+                             'vmin': layer.vmin, 'vmax': layer.vmax})
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+    return buf.getvalue()
@@ -0,0 +1,395 @@
+import csv
+import importlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from kmd_cluster import assign_clusters, fit_kmeans, rows_per_block, stream_kmeans
+from kmd_instrument import array_bytes
+from kmd_io import Region, content_hash, file_hash, read_wdf_bytes, read_wdf_path, region_view, wdf_spectra_view
+from kmd_layers import colourise, composite_layers, encode_png, generate_layers, to_image
+from kmd_preprocess import NO_PREPROCESSING, block_pixels_for, crop_channels, preprocess_block, preprocess_cube
+from kmd_reduce import NO_REDUCTION, fit_basis, project, project_block
+from kmd_render import layers_figure
+from kmd_session import Session, export_session
+from kmd_spatial import NO_SPATIAL, feature_settings, neighbourhood_features, refines, spatial_refine
+from kmd_spectra import WavenumberIndex, cluster_mean_spectra
+
+
+# Tasks - Load -> cluster -> layer -> composite pipeline
+#
+# The web app and kmd_cli.py are both thin front ends over these functions. None of the
+# kmd_* modules import Streamlit, so the CLI, the benchmarks and the sweep's worker
+# processes can use them without it.
+
+
+# Memory budget used when streaming and for the block size of the reductions
+DEFAULT_BUDGET_BYTES = 256 * 1024 * 1024
+
+
+def open_cube(source, streaming=False):
+    """Cube of a WDF file given as a path or as its contents.
+
+    Streaming mode views the DATA block in place (memory-mapped for a path) instead of
+    decoding the file with renishawWiRE.
+    """
+    if streaming:
+        return wdf_spectra_view(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return read_wdf_bytes(source)
+    return read_wdf_path(source)
+
+
+def load(source, streaming=False):
+    # Dataset key (hash of the contents) and Cube of a WDF file
+    key = content_hash(source) if isinstance(source, (bytes, bytearray, memoryview)) else file_hash(source)
+    return key, open_cube(source, streaming)
+
+
+def block_pixels(cube, budget_bytes=DEFAULT_BUDGET_BYTES):
+    # Pixels per block for the single-pass reductions over the cube
+    return rows_per_block(cube.shape, budget_bytes) * cube.shape[1]
+
+
+def _cached(cache, key, load):
+    # load() through a shared cache (anything with get_or_load) when the front end gives one
+    return load() if cache is None else cache.get_or_load(key, load)
+
+
+def _no_progress(done, total, message=None):
+    pass
+
+
+class _Memo(dict):
+    # Cache for the length of one call, so the preview's features are not computed twice
+    def get_or_load(self, key, load):
+        if key not in self:
+            self[key] = load()
+        return self[key]
+
+
+def scratch_array(shape):
+    # Float32 array in an anonymous temporary file, for intermediate cubes kept off the heap
+    return np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=shape)
+
+
+def model_settings(preprocessing=NO_PREPROCESSING, reduction=NO_REDUCTION, spatial=NO_SPATIAL):
+    # Everything that changes the clustering, as one hashable ModelStore key
+    if spatial != NO_SPATIAL:
+        return preprocessing, reduction, spatial
+    if reduction == NO_REDUCTION:
+        return preprocessing
+    return preprocessing, reduction
+
+
+def effective_reduction(reduction, streaming):
+    # Randomized SVD needs the whole matrix in memory; streaming reads blocks instead
+    if streaming and reduction.method == 'svd':
+        return reduction._replace(method='incremental')
+    return reduction
+
+
+def preprocess(cube, preprocessing=NO_PREPROCESSING, budget_bytes=DEFAULT_BUDGET_BYTES, streaming=False,
+               cache=None, key=None, progress=None):
+    """Cube the clustering runs on; the raw cube is kept for the spectra and layers.
+
+    Streaming writes it to a temporary file instead of the heap. With a `cache` it is
+    loaded once under the dataset `key` and the settings.
+    """
+    if preprocessing == NO_PREPROCESSING:
+        return cube
+
+    def run():
+        band = crop_channels(cube.xdata, preprocessing.crop)
+        out = scratch_array(cube.shape[:2] + (band.stop - band.start,)) if streaming else None
+        return preprocess_cube(cube, preprocessing, block_pixels_for(cube.xdata, preprocessing, budget_bytes), out,
+                               progress)
+
+    return _cached(cache, (key, preprocessing, streaming), run)
+
+
+def reduction_basis(cube, reduction, budget_bytes=DEFAULT_BUDGET_BYTES, cache=None, key=None,
+                    preprocessing=NO_PREPROCESSING):
+    # Principal components of a preprocessed cube, cached per dataset and settings, not per k
+    return _cached(cache, (key, preprocessing, reduction, 'basis'),
+                   lambda: fit_basis(cube.spectra, reduction, block_pixels(cube, budget_bytes)))
+
+
+def cached_basis(cache, key, preprocessing, reduction):
+    # The basis reduction_basis cached, or None
+    return cache.get((key, preprocessing, reduction, 'basis'))
+
+
+def reduce(cube, reduction=NO_REDUCTION, budget_bytes=DEFAULT_BUDGET_BYTES, basis=None, cache=None, key=None,
+           preprocessing=NO_PREPROCESSING):
+    # Cube of principal-component scores, or the cube itself without a reduction
+    if reduction == NO_REDUCTION:
+        return cube
+    if basis is None:
+        basis = reduction_basis(cube, reduction, budget_bytes, cache, key, preprocessing)
+    return _cached(cache, (key, preprocessing, reduction, 'scores'),
+                   lambda: project(cube, basis, block_pixels(cube, budget_bytes)))
+
+
+def neighbourhood(cube, spatial=NO_SPATIAL, streaming=False, cache=None, key=None, preprocessing=NO_PREPROCESSING,
+                  reduction=NO_REDUCTION):
+    # Neighbourhood-averaged features, or the cube itself without a neighbourhood radius
+    if spatial.radius == 0:
+        return cube
+
+    def run():
+        out = scratch_array(cube.shape) if streaming else None
+        return neighbourhood_features(cube, spatial.radius, spatial.weight, out)
+
+    return _cached(cache, (key, preprocessing, reduction, feature_settings(spatial), streaming), run)
+
+
+def features(xdata, preprocessing=NO_PREPROCESSING, basis=None, budget_bytes=DEFAULT_BUDGET_BYTES):
+    # Function taking a block of raw spectra into the space the clustering ran in; the
+    # preprocessing runs on pieces whose working arrays fit in the budget
+    band = crop_channels(xdata, preprocessing.crop)
+    kept = np.asarray(xdata)[band]
+    piece = block_pixels_for(xdata, preprocessing, budget_bytes)
+
+    def transform(block):
+        if preprocessing != NO_PREPROCESSING:
+            if len(block) > piece:
+                block = np.concatenate([preprocess_block(block[start:start + piece, band], kept, preprocessing)
+                                        for start in range(0, len(block), piece)])
+            else:
+                block = preprocess_block(block[:, band], kept, preprocessing)
+        if basis is not None:
+            block = project_block(block, basis)
+        return block
+
+    return transform
+
+
+def assign_to_preview(cube, preview, centroids, streaming=False, budget_bytes=DEFAULT_BUDGET_BYTES,
+                      preprocessing=NO_PREPROCESSING, reduction=NO_REDUCTION, spatial=NO_SPATIAL,
+                      cache=None, preview_key=None, progress=None):
+    """ClusterModel labelling every pixel of `cube` with the nearest of the centroids fitted on `preview`.
+
+    The pixels are read a block of rows at a time and taken into the preview's feature
+    space (its preprocessing and components, from the `cache` when it still holds them).
+    Neighbourhood features are not applied; label smoothing and region sizes are.
+    """
+    report = progress or _no_progress
+    reduction = effective_reduction(reduction, streaming)
+    basis = None
+    if reduction != NO_REDUCTION:
+        report(0, 0, "Reducing")
+        preprocessed = preprocess(preview, preprocessing, budget_bytes, streaming, cache, preview_key)
+        basis = reduction_basis(preprocessed, reduction, budget_bytes, cache, preview_key, preprocessing)
+
+    report(0, 0, "Assigning pixels to the preview clusters: blocks")
+    transform = features(cube.xdata, preprocessing, basis, budget_bytes)
+    model = assign_clusters(cube.spectra, centroids, budget_bytes, transform, progress)
+    if refines(spatial):
+        report(0, 0, "Smoothing labels")
+        model = spatial_refine(model, cube.spectra, spatial, budget_bytes, transform)
+    return model
+
+
+def cluster(cube, k, streaming=False, budget_bytes=DEFAULT_BUDGET_BYTES, preprocessing=NO_PREPROCESSING,
+            reduction=NO_REDUCTION, preview_step=1, spatial=NO_SPATIAL, cache=None, store=None, key=None,
+            progress=None, sweep=None):
+    """ClusterModel for k clusters, fitted on the whole matrix or streamed within the budget.
+
+    With preview_step > 1 the fit runs on every preview_step-th row and column only, and
+    every pixel is then assigned to the nearest of those centroids a block at a time (the
+    neighbourhood features of `spatial` are then used for the preview fit only).
+
+    The web app shares work between sessions through the optional hooks: `cache` holds
+    the intermediate cubes and `store` (a ModelStore) the fitted models, both under the
+    dataset `key`; `progress(done, total, message)` follows the stages and may raise to
+    abandon them; `sweep(key, data_matrix, k, settings, progress)` may return a model
+    fitted elsewhere before a full fit is started.
+    """
+    report = progress or _no_progress
+    reduction = effective_reduction(reduction, streaming)
+    if preview_step > 1:
+        cache = _Memo() if cache is None else cache
+        preview_key = None if key is None else f"{key}:step{preview_step}"
+        preview = region_view(cube, Region(step=preview_step))
+        model = cluster(preview, k, streaming, budget_bytes, preprocessing, reduction, spatial=spatial, cache=cache,
+                        store=store, key=preview_key, progress=progress)
+        return assign_to_preview(cube, preview, model.centroids, streaming, budget_bytes, preprocessing, reduction,
+                                 spatial, cache, preview_key, progress)
+
+    # Cluster on the preprocessed (and reduced) spectra; the labels apply to the raw cube pixel for pixel
+    report(0, 0, "Preprocessing")
+    cube = preprocess(cube, preprocessing, budget_bytes, streaming, cache, key, progress)
+    report(0, 0, "Reducing")
+    cube = reduce(cube, reduction, budget_bytes, cache=cache, key=key, preprocessing=preprocessing)
+    report(0, 0, "Averaging neighbourhoods")
+    cube = neighbourhood(cube, spatial, streaming, cache, key, preprocessing, reduction)
+
+    settings = model_settings(preprocessing, reduction, feature_settings(spatial))
+    if streaming:
+        report(0, 0, "Streaming K-means: blocks read")
+        if store is None:
+            model = stream_kmeans(cube.spectra, k, budget_bytes, progress=progress)
+        else:
+            model = store.get_or_stream(key, cube.spectra, k, budget_bytes, settings, progress)
+    else:
+        shp = cube.shape
+        data_matrix = cube.spectra.reshape((shp[0] * shp[1], shp[2]))
+
+        # Take a fit made elsewhere for this k rather than fitting the same model twice
+        if sweep is not None and store is not None and store.get(key, k, settings) is None:
+            model = sweep(key, data_matrix, k, settings, report)
+            if model is not None and store.get(key, k, settings) is None:
+                store.put(key, k, model, settings)
+
+        report(0, 0, "K-means: iterations")
+        if store is None:
+            model = fit_kmeans(data_matrix, k, progress=progress)
+        else:
+            model = store.get_or_fit(key, data_matrix, k, settings, progress)
+
+    # Label smoothing and small-region removal start from the plain fit, which stays in the store
+    if refines(spatial):
+        report(0, 0, "Smoothing labels")
+        model = spatial_refine(model, cube.spectra, spatial, budget_bytes)
+        if store is not None:
+            store.put(key, k, model, model_settings(preprocessing, reduction, spatial),
+                      ('streaming', budget_bytes) if streaming else 'full')
+    return model
+
+
+def working_set_bytes(cube, k, preprocessing=NO_PREPROCESSING, reduction=NO_REDUCTION, streaming=False,
+                      budget_bytes=DEFAULT_BUDGET_BYTES, spatial=NO_SPATIAL):
+    """Estimated bytes held while clustering a cube with these settings, all float32.
+
+    Counts the spectra when they are in memory (a view of the upload or of a file costs
+    nothing), the preprocessed cube, the component scores (plus the centred copy randomized
+    SVD makes), the neighbourhood features, the labels and K-means' distance matrix (four
+    of them for the spatial refinement). Streaming stays within the budget.
+    """
+    rows, cols, channels = cube.shape
+    pixels = rows * cols
+    total = array_bytes(cube.spectra) + pixels * 4
+    if refines(spatial):
+        total += 4 * pixels * k * 4
+    if streaming:
+        return total + budget_bytes
+
+    band = crop_channels(cube.xdata, preprocessing.crop)
+    width = band.stop - band.start
+    if preprocessing != NO_PREPROCESSING:
+        total += pixels * width * 4
+    if reduction != NO_REDUCTION:
+        if reduction.method == 'svd':
+            total += pixels * width * 4
+        width = min(reduction.components, width)
+        total += pixels * width * 4
+    if spatial.radius > 0:
+        total += pixels * width * 4
+
+    return total + pixels * k * 4
+
+
+def prewarm_clustering():
+    """Import the clustering stack and fit a tiny model, so the first real request pays for neither.
+
+    Safe to call from a background thread or a worker process.
+    """
+    # Importing is the warm-up: the WDF reader and SciPy's filters are slow to load the first time
+    for module in ('renishawWiRE', 'scipy.ndimage'):
+        importlib.import_module(module)
+
+    fit_kmeans(np.random.default_rng(0).random((64, 4), dtype=np.float32), 2)
+
+
+def mean_spectra(cube, model, k, budget_bytes=DEFAULT_BUDGET_BYTES):
+    return cluster_mean_spectra(cube.spectra, model.labels, k, block_pixels(cube, budget_bytes))
+
+
+def layers(cube, model, specs, method='mean', baseline='none', upscale=5, sigma=2, threshold=3,
+           budget_bytes=DEFAULT_BUDGET_BYTES, workers=None):
+    return generate_layers(cube.spectra, model.labels, WavenumberIndex(cube.xdata), specs, method, baseline,
+                           upscale, sigma, threshold, block_pixels(cube, budget_bytes), workers)
+
+
+def composite(layer_list, alphas=None, mode='additive'):
+    return to_image(composite_layers(layer_list, alphas, mode))
+
+
+def write_mean_spectra(path, xdata, means):
+    # One row per wavenumber, one column per cluster
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['wavenumber'] + [f'cluster_{i}' for i in range(len(means))])
+        writer.writerows(np.column_stack([xdata, means.T]).tolist())
+
+
+def process_file(path, out_dir, k, specs=(), streaming=False, budget_bytes=DEFAULT_BUDGET_BYTES,
+                 method='mean', baseline='none', upscale=5, sigma=2, threshold=3, blend='additive',
+                 workers=None, preprocessing=NO_PREPROCESSING, reduction=NO_REDUCTION, session=False, preview_step=1,
+                 spatial=NO_SPATIAL):
+    """Run the whole pipeline on one WDF file and write the results into out_dir.
+
+    Writes labels.npy (rows x columns), mean_spectra.csv, layer_NN.png for every spec,
+    composite.png and figure.png (the composite with a colour bar per layer) when there are
+    layers, and summary.json (plus session.zip for the web app's session import when
+    `session` is set). Returns the summary.
+    Clustering runs on the preprocessed (and reduced) spectra; the mean spectra and layers
+    use the raw ones.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    dataset_key, cube = load(path, streaming)
+    reduction = effective_reduction(reduction, streaming)
+    model = cluster(cube, k, streaming, budget_bytes, preprocessing, reduction, preview_step, spatial)
+    means, counts = mean_spectra(cube, model, k, budget_bytes)
+
+    np.save(os.path.join(out_dir, 'labels.npy'), model.labels.reshape(cube.shape[:2]))
+    write_mean_spectra(os.path.join(out_dir, 'mean_spectra.csv'), cube.xdata, means)
+
+    layer_list = []
+    if specs:
+        index = WavenumberIndex(cube.xdata)
+        for number, spec in enumerate(specs, start=1):
+            if not 0 <= spec.cluster < k:
+                raise ValueError(f"Layer {number}: cluster {spec.cluster} does not exist for k={k}.")
+            if index.clip(spec.start, spec.end) is None:
+                raise ValueError(f"Layer {number}: the range lies outside the spectrum.")
+        layer_list = layers(cube, model, list(specs), method, baseline, upscale, sigma, threshold,
+                            budget_bytes, workers)
+
+    for number, layer in enumerate(layer_list, start=1):
+        with open(os.path.join(out_dir, f'layer_{number:02d}.png'), 'wb') as f:
+            f.write(encode_png(to_image(colourise(layer))))
+    if layer_list:
+        composite(layer_list, mode=blend).save(os.path.join(out_dir, 'composite.png'))
+        layers_figure(layer_list, mode=blend).save(os.path.join(out_dir, 'figure.png'))
+
+    if session:
+        export_session(os.path.join(out_dir, 'session.zip'), Session(
+            name=os.path.basename(path), dataset_key=dataset_key, k=k, labels=model.labels.reshape(cube.shape[:2]),
+            centroids=model.centroids, inertia=model.inertia, mean_spectra=means, counts=counts, xdata=cube.xdata,
+            preprocessing=preprocessing, reduction=reduction,
+            method=('streaming', budget_bytes) if streaming else 'full', layers=layer_list, spatial=spatial))
+
+    summary = {
+        'file': os.path.abspath(path),
+        'dataset': dataset_key,
+        'shape': list(cube.shape),
+        'clusters': k,
+        'preprocessing': preprocessing._asdict(),
+        'reduction': reduction._asdict(),
+        'preview_step': preview_step,
+        'spatial': spatial._asdict(),
+        'pixels_per_cluster': counts.tolist(),
+        'inertia': model.inertia,
+        'layers': [{'file': f'layer_{number:02d}.png', 'name': layer.name, 'colour': layer.colour,
+                    'vmin': layer.vmin, 'vmax': layer.vmax}
+                   for number, layer in enumerate(layer_list, start=1)],
+    }
+    with open(os.path.join(out_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    return summary
@@ -0,0 +1,217 @@
+from collections import namedtuple
+
+import numpy as np
+
+from kmd_io import Cube
+from kmd_spectra import WavenumberIndex
+
+
+# Tasks - Spectral preprocessing ahead of clustering
+
+
+# Preprocessing settings. The tuple is hashable, so it doubles as the cache and ModelStore key.
+#   crop:       (start, end) wavenumber range kept for clustering, or None for the whole axis
+#   despike:    modified z-score above which a channel counts as a cosmic ray, 0 to turn it off
+#   baseline:   'none', 'poly' (iterative polynomial fit) or 'als' (asymmetric least squares)
+#   poly_order: order of the polynomial baseline
+#   als_lambda, als_p: smoothness and asymmetry of the ALS baseline
+#   normalise:  'none', 'vector' (unit length) or 'area' (unit area under the spectrum)
+Preprocessing = namedtuple('Preprocessing', ['crop', 'despike', 'baseline', 'poly_order',
+                                             'als_lambda', 'als_p', 'normalise'],
+                           defaults=[None, 0.0, 'none', 3, 1e5, 0.01, 'none'])
+
+NO_PREPROCESSING = Preprocessing()
+
+# Iterations of the baseline fits; both converge well before this on Raman spectra
+POLY_ITERATIONS = 20
+ALS_ITERATIONS = 10
+
+# Bytes each stage holds per value of the block on top of the float32 block itself: the
+# despike filter output, residual and masks; the polynomial working copy, fit and product;
+# the six float64 arrays of the ALS solve, its mask and the float32 result
+STAGE_BYTES = {'despike': 16, 'poly': 12, 'als': 53, 'normalise': 4}
+
+
+def crop_channels(xdata, crop):
+    # Slice of the cube columns kept by the crop
+    if crop is None:
+        return slice(0, len(xdata))
+    band = WavenumberIndex(xdata).channels(*crop)
+    if band.stop - band.start < 2:
+        raise ValueError("The crop range keeps fewer than two channels.")
+    return band
+
+
+def block_pixels_for(xdata, settings, budget_bytes):
+    """Pixels per preprocessing block whose working arrays fit in budget_bytes.
+
+    Counts the raw and the preprocessed float32 block plus the costliest chosen stage, as
+    the stages run one after another.
+    """
+    band = crop_channels(xdata, settings.crop)
+    stages = [stage for stage, used in (('despike', settings.despike > 0), ('poly', settings.baseline == 'poly'),
+                                        ('als', settings.baseline == 'als'), ('normalise', settings.normalise != 'none'))
+              if used]
+    per_value = 8 + max([STAGE_BYTES[stage] for stage in stages], default=0)
+    return int(max(1, budget_bytes // ((band.stop - band.start) * per_value)))
+
+
+def remove_spikes(block, threshold, window=5):
+    """Cosmic rays replaced by the local median of their spectrum.
+
+    A channel is a spike when it rises above the `window`-channel running median by more
+    than `threshold` modified z-scores (median absolute deviation of that residual).
+    Raman bands are much wider than the window and pass through the median unchanged;
+    the spike and its direct neighbours are replaced.
+    """
+    from scipy.ndimage import binary_dilation, median_filter
+
+    smoothed = median_filter(block, size=(1, window), mode='nearest')
+    residual = block - smoothed
+    mad = np.median(np.abs(residual - np.median(residual, axis=1, keepdims=True)), axis=1, keepdims=True)
+    spikes = 0.6745 * residual > threshold * np.maximum(mad, np.finfo(block.dtype).tiny)
+    if not spikes.any():
+        return block
+
+    spikes = binary_dilation(spikes, structure=np.ones((1, 3), dtype=bool))
+    block[spikes] = smoothed[spikes]
+    return block
+
+
+def poly_baseline(block, xdata, order, n_iter=POLY_ITERATIONS):
+    """Iterative (modified) polynomial baseline of every spectrum in the block.
+
+    All spectra share one Vandermonde matrix, so each iteration is two small matrix
+    products over the whole block; points above the fit are clipped to it each time.
+    """
+    x = np.asarray(xdata, dtype=np.float64)
+    x = (2 * x - x.min() - x.max()) / max(x.max() - x.min(), np.finfo(np.float64).tiny)
+    vander = np.vander(x, order + 1).astype(block.dtype)
+    projection = np.linalg.pinv(vander).T
+
+    working = block.copy()
+    for _ in range(n_iter):
+        base = (working @ projection) @ vander.T
+        np.minimum(working, base, out=working)
+    return base
+
+
+def als_baseline(block, lam, p, n_iter=ALS_ITERATIONS):
+    """Asymmetric least squares baseline (Eilers & Boelens) of every spectrum in the block.
+
+    Each iteration solves (W + lam D'D) z = W y for all spectra at once: D'D is the same
+    pentadiagonal matrix for every spectrum and only the diagonal weights W differ, so a
+    banded LDL' factorisation is run along the channels with the spectra as a vector axis.
+    """
+    # Channels first, so each step of the recursions reads one contiguous row of spectra
+    y = np.ascontiguousarray(block.T, dtype=np.float64)
+    n = y.shape[0]
+    if n < 3:
+        return block.copy()
+
+    # Bands of D'D for second differences: every row (1, -2, 1) of D adds its outer product
+    rows = np.ones(n - 2)
+    d0 = lam * np.convolve(rows, [1.0, 4.0, 1.0])
+    d1 = lam * np.convolve(rows, [-2.0, -2.0])
+    d2 = lam * rows
+
+    w = np.ones_like(y)
+    diag = np.empty_like(y)
+    l1 = np.zeros_like(y)
+    l2 = np.zeros_like(y)
+    z = np.empty_like(y)
+    for _ in range(n_iter):
+        # Factorise W + lam D'D = L diag L'
+        for i in range(n):
+            a = w[i] + d0[i]
+            if i >= 2:
+                l2[i] = d2[i - 2] / diag[i - 2]
+                a = a - l2[i] ** 2 * diag[i - 2]
+            if i >= 1:
+                b = d1[i - 1] - (l2[i] * l1[i - 1] * diag[i - 2] if i >= 2 else 0)
+                l1[i] = b / diag[i - 1]
+                a = a - l1[i] ** 2 * diag[i - 1]
+            diag[i] = a
+
+        # Forward and back substitution, in place on W y
+        np.multiply(w, y, out=z)
+        for i in range(n):
+            if i >= 1:
+                z[i] -= l1[i] * z[i - 1]
+            if i >= 2:
+                z[i] -= l2[i] * z[i - 2]
+        z /= diag
+        for i in range(n - 2, -1, -1):
+            z[i] -= l1[i + 1] * z[i + 1]
+            if i + 2 < n:
+                z[i] -= l2[i + 2] * z[i + 2]
+
+        w.fill(1 - p)
+        w[y > z] = p
+
+    return z.T.astype(block.dtype)
+
+
+def normalise_spectra(block, xdata, method):
+    if method == 'vector':
+        scale = np.linalg.norm(block, axis=1, keepdims=True)
+    elif method == 'area':
+        # Trapezoid weights of the axis, so the area is one matrix-vector product
+        dx = np.abs(np.diff(np.asarray(xdata, dtype=np.float64))) / 2
+        weights = np.zeros(len(xdata), dtype=np.float64)
+        weights[:-1] += dx
+        weights[1:] += dx
+        scale = np.abs(block @ weights.astype(block.dtype))[:, None]
+    else:
+        raise ValueError(f"Unknown normalisation: {method}")
+    block /= np.where(scale > 0, scale, 1)
+    return block
+
+
+def preprocess_block(block, xdata, settings, copy=True):
+    """Preprocessed float32 (pixels, channels) block whose columns match xdata.
+
+    The block is copied first unless `copy` is False, in which case a writable float32
+    block is preprocessed in place and returned.
+    """
+    block = np.array(block, dtype=np.float32) if copy else np.asarray(block, dtype=np.float32)
+
+    if settings.despike > 0:
+        block = remove_spikes(block, settings.despike)
+    if settings.baseline == 'poly':
+        block -= poly_baseline(block, xdata, settings.poly_order)
+    elif settings.baseline == 'als':
+        block -= als_baseline(block, settings.als_lambda, settings.als_p)
+    elif settings.baseline != 'none':
+        raise ValueError(f"Unknown baseline: {settings.baseline}")
+    if settings.normalise != 'none':
+        block = normalise_spectra(block, xdata, settings.normalise)
+
+    return block
+
+
+def preprocess_cube(cube, settings, block_pixels=8192, out=None, progress=None):
+    """Cube of the preprocessed float32 spectra with the cropped wavenumber axis.
+
+    The crop is applied first, so the later stages only see the kept channels. The
+    spectra (possibly memory-mapped) are processed `block_pixels` at a time; pass `out`
+    (e.g. a memory-mapped array of the cropped shape) to keep the result off the heap.
+    `progress(done, total)` is called after every block.
+    """
+    band = crop_channels(cube.xdata, settings.crop)
+    kept = np.asarray(cube.xdata)[band]
+    rows, cols, channels = cube.shape
+    data_matrix = cube.spectra.reshape((rows * cols, channels))
+
+    if out is None:
+        out = np.empty((rows, cols, len(kept)), dtype=np.float32)
+    result = out.reshape((rows * cols, len(kept)))
+    for start in range(0, len(result), block_pixels):
+        # Copy the raw block straight into the output and work on it there, without a temporary
+        rows_out = result[start:start + block_pixels]
+        rows_out[...] = data_matrix[start:start + block_pixels, band]
+        preprocess_block(rows_out, kept, settings, copy=False)
+        if progress is not None:
+            progress(min(start + block_pixels, len(result)), len(result))
+
+    return Cube(spectra=out, xdata=kept, shape=out.shape)
@@ -0,0 +1,99 @@
+from collections import namedtuple
+
+import numpy as np
+
+from kmd_io import Cube
+
+
+# Tasks - Dimensionality reduction ahead of clustering
+
+
+# Reduction settings, hashable so they can be part of the cache and ModelStore keys.
+#   method:     'none', 'svd' (randomized SVD of the whole matrix) or 'incremental'
+#               (incremental PCA, one block of spectra at a time)
+#   components: number of components kept, or the upper limit when a variance target is set
+#   variance:   fraction of the variance to keep (0 keeps exactly `components`)
+Reduction = namedtuple('Reduction', ['method', 'components', 'variance'], defaults=['none', 20, 0.0])
+
+NO_REDUCTION = Reduction()
+
+# Principal axes of a dataset: the mean spectrum, the (components, channels) basis and the
+# fraction of the total variance each component explains
+Basis = namedtuple('Basis', ['mean', 'components', 'explained_variance_ratio'])
+
+
+def _column_moments(data_matrix, block_pixels):
+    # Mean spectrum and total variance, accumulated a block at a time
+    sums = np.zeros(data_matrix.shape[1], dtype=np.float64)
+    squares = 0.0
+    for start in range(0, len(data_matrix), block_pixels):
+        # float32 blocks, accumulated in float64
+        block = np.asarray(data_matrix[start:start + block_pixels], dtype=np.float32)
+        sums += block.sum(axis=0, dtype=np.float64)
+        squares += float(np.square(block).sum(dtype=np.float64))
+    n = len(data_matrix)
+    mean = sums / n
+    total_variance = (squares - n * float(mean @ mean)) / max(n - 1, 1)
+    return mean, total_variance
+
+
+def _keep(ratios, reduction):
+    # Number of leading components that meet the variance target
+    if reduction.variance <= 0:
+        return len(ratios)
+    return int(min(len(ratios), np.searchsorted(np.cumsum(ratios), reduction.variance) + 1))
+
+
+def fit_basis(spectra, reduction, block_pixels=8192):
+    """Basis of the leading principal components of a (rows, columns, channels) cube.
+
+    'svd' runs a randomized SVD of the mean-centred matrix, which needs it in memory;
+    'incremental' reads the cube `block_pixels` spectra at a time and suits memory-mapped
+    maps. With a variance target the smallest number of components reaching it is kept.
+    """
+    data_matrix = spectra.reshape((-1, spectra.shape[-1]))
+    n_components = int(min(reduction.components, *data_matrix.shape))
+
+    if reduction.method == 'svd':
+        from sklearn.utils.extmath import randomized_svd
+
+        mean, total_variance = _column_moments(data_matrix, block_pixels)
+        centred = np.asarray(data_matrix, dtype=np.float32) - mean.astype(np.float32)
+        _, singular_values, components = randomized_svd(centred, n_components, random_state=0)
+        del centred
+        ratios = singular_values.astype(np.float64) ** 2 / max(len(data_matrix) - 1, 1) / total_variance
+    elif reduction.method == 'incremental':
+        from sklearn.decomposition import IncrementalPCA
+
+        ipca = IncrementalPCA(n_components=n_components)
+        # Every partial fit needs at least n_components spectra
+        step = max(block_pixels, n_components)
+        for start in range(0, len(data_matrix), step):
+            block = np.asarray(data_matrix[start:start + step], dtype=np.float32)
+            if len(block) >= n_components:
+                ipca.partial_fit(block)
+        mean, components, ratios = ipca.mean_, ipca.components_, ipca.explained_variance_ratio_
+    else:
+        raise ValueError(f"Unknown reduction: {reduction.method}")
+
+    keep = _keep(ratios, reduction)
+    return Basis(mean=np.asarray(mean, dtype=np.float32), components=np.asarray(components[:keep], dtype=np.float32),
+                 explained_variance_ratio=np.asarray(ratios[:keep], dtype=np.float64))
+
+
+def project_block(block, basis):
+    # Component scores of a (pixels, channels) block of spectra
+    return np.asarray(block, dtype=np.float32) @ basis.components.T - basis.mean @ basis.components.T
+
+
+def project(cube, basis, block_pixels=8192):
+    # Cube of component scores, one channel per component, computed a block of spectra at a time
+    rows, cols, channels = cube.shape
+    data_matrix = cube.spectra.reshape((rows * cols, channels))
+
+    scores = np.empty((rows * cols, len(basis.components)), dtype=np.float32)
+    for start in range(0, len(scores), block_pixels):
+        scores[start:start + block_pixels] = project_block(data_matrix[start:start + block_pixels], basis)
+
+    scores = scores.reshape((rows, cols, len(basis.components)))
+    return Cube(spectra=scores, xdata=np.arange(1, len(basis.components) + 1, dtype=np.float32), shape=scores.shape)
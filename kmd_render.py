@@ -0,0 +1,114 @@
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from kmd_layers import colormap_indices, colormap_lut, composite_layers, to_image
+
+
+# Tasks - Fast map rendering: lookup tables and PIL instead of matplotlib figures
+
+
+# Colours of the single-cluster map on page 1 (the two ends of matplotlib's 'Reds')
+HIGHLIGHT_COLOURS = np.array([[1.0, 0.961, 0.941], [0.404, 0.0, 0.051]], dtype=np.float32)
+
+# Smallest side of a displayed cluster map, so small maps are enlarged without blurring
+DISPLAY_SIZE = 400
+
+
+@lru_cache(maxsize=None)
+def named_lut(name, steps):
+    # (steps, 3) table sampled from a matplotlib colormap, built once per process
+    import matplotlib
+
+    lut = np.asarray(matplotlib.colormaps[name].resampled(steps)(np.arange(steps))[:, :3], dtype=np.float32)
+    lut.flags.writeable = False
+    return lut
+
+
+def enlarge(rgb, min_size=DISPLAY_SIZE):
+    # Nearest-neighbour enlargement of a small RGB array until its shorter side reaches min_size
+    factor = max(1, int(np.ceil(min_size / max(1, min(rgb.shape[:2])))))
+    if factor == 1:
+        return rgb
+    return np.repeat(np.repeat(rgb, factor, axis=0), factor, axis=1)
+
+
+def highlight_map_image(labels_2d, cluster):
+    # Page 1 map: the selected cluster in dark red on a pale background
+    return to_image(enlarge(HIGHLIGHT_COLOURS[(labels_2d == cluster).astype(np.intp)]))
+
+
+def cluster_map_image(labels_2d, k):
+    # Page 2 map: every cluster in its own viridis colour, as imshow draws the label array
+    lut = named_lut('viridis', k)
+    return to_image(enlarge(lut[labels_2d]))
+
+
+def cluster_legend_image(k, swatch=24, width=110):
+    # Key for cluster_map_image: one colour swatch per cluster number
+    lut = (named_lut('viridis', k) * 255 + 0.5).astype(np.uint8)
+    image = Image.new('RGB', (width, swatch * k + 4), 'white')
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    for cluster in range(k):
+        top = 2 + cluster * swatch
+        draw.rectangle((2, top + 2, swatch - 2, top + swatch - 2), fill=tuple(int(c) for c in lut[cluster]))
+        draw.text((swatch + 6, top + swatch // 2), f"Cluster {cluster}", fill='black', font=font, anchor='lm')
+    return image
+
+
+def nice_ticks(vmin, vmax, count=6):
+    # Round tick values inside [vmin, vmax], about `count` of them
+    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmax <= vmin:
+        return [float(vmin)]
+    raw = (vmax - vmin) / max(count - 1, 1)
+    magnitude = 10 ** np.floor(np.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    first = np.ceil(vmin / step) * step
+    return [float(t) for t in np.arange(first, vmax + step * 1e-9, step)]
+
+
+def colourbar_image(colour, vmin, vmax, height, bar_width=20, label_width=70, margin=8):
+    """Vertical colour bar of a layer colormap with tick labels, as a small PIL image.
+
+    The bar uses the same lookup table and binning as the layer image, with vmax at the top.
+    """
+    bar_height = max(1, height - 2 * margin)
+    values = vmax - (np.arange(bar_height) + 0.5) / bar_height * (vmax - vmin)
+    rows = colormap_lut(colour)[colormap_indices(values, vmin, vmax)]
+    bar = to_image(np.repeat(rows[:, None, :], bar_width, axis=1))
+
+    image = Image.new('RGB', (bar_width + label_width + 4, height), 'white')
+    image.paste(bar, (2, margin))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((2, margin, 2 + bar_width - 1, margin + bar_height - 1), outline='black')
+    font = ImageFont.load_default()
+    for tick in nice_ticks(vmin, vmax):
+        y = margin + (vmax - tick) / (vmax - vmin) * (bar_height - 1) if vmax > vmin else margin
+        draw.line((2 + bar_width, y, 2 + bar_width + 4, y), fill='black')
+        draw.text((2 + bar_width + 7, y), f"{tick:g}", fill='black', font=font, anchor='lm')
+    return image
+
+
+def figure_image(map_image, ranges, gap=0):
+    """Final figure: the map with one colour bar per (colour, vmin, vmax) range to its right.
+
+    The bars are drawn from the colormaps at the map's height, so any number of them fits.
+    """
+    map_image = map_image.convert('RGB')
+    bars = [colourbar_image(colour, vmin, vmax, height=map_image.height) for colour, vmin, vmax in ranges]
+
+    image = Image.new('RGB', (map_image.width + sum(bar.width + gap for bar in bars), map_image.height), 'white')
+    image.paste(map_image, (0, 0))
+    x = map_image.width
+    for bar in bars:
+        image.paste(bar, (x + gap, 0))
+        x += bar.width + gap
+    return image
+
+
+def layers_figure(layers, alphas=None, mode='additive', gap=0):
+    # Final figure of page 3 layers: their composite and a colour bar for each, in one render
+    combined = composite_layers(layers, alphas, mode)
+    return figure_image(to_image(combined), [(layer.colour, layer.vmin, layer.vmax) for layer in layers], gap)
@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+
+from kmd_layers import Layer
+from kmd_preprocess import Preprocessing
+from kmd_reduce import Reduction
+from kmd_spatial import NO_SPATIAL, Spatial
+
+
+# Tasks - Session export and import
+#
+# A session file is a zip archive holding manifest.json plus one .npy member per array,
+# each deflate-compressed and written or read a chunk at a time. Importing extracts the
+# members to a directory and memory-maps them, so even large layer stacks cost no heap.
+
+
+FORMAT = 'kmd-session'
+VERSION = 1
+
+# Bytes copied per step when writing and extracting archive members
+CHUNK_BYTES = 1 << 20
+
+# Clustering result with everything pages 1-5 need to show it again without the WDF file
+Session = namedtuple('Session', ['name', 'dataset_key', 'k', 'labels', 'centroids', 'inertia', 'mean_spectra',
+                                 'counts', 'xdata', 'preprocessing', 'reduction', 'method', 'layers', 'spatial'],
+                     defaults=[NO_SPATIAL])
+
+
+def _write_array(archive, name, array):
+    # np.save straight into the compressed member, without an uncompressed copy in memory
+    with archive.open(name, 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+def _label_dtype(k):
+    return np.uint8 if k <= 256 else np.uint16
+
+
+def export_session(target, session):
+    """Write a session to a path or binary file object.
+
+    The labels are stored as the smallest unsigned type that holds k, the spectra and
+    layer images as float32. The raw spectra are not included.
+    """
+    layers = list(session.layers)
+    manifest = {
+        'format': FORMAT, 'version': VERSION, 'name': session.name, 'dataset': session.dataset_key,
+        'k': int(session.k), 'inertia': float(session.inertia),
+        'preprocessing': session.preprocessing._asdict(), 'reduction': session.reduction._asdict(),
+        'spatial': session.spatial._asdict(),
+        'method': session.method,
+        'layers': [{'name': layer.name, 'colour': layer.colour, 'vmin': float(layer.vmin), 'vmax': float(layer.vmax)}
+                   for layer in layers],
+    }
+    with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+        _write_array(archive, 'labels.npy', np.asarray(session.labels).astype(_label_dtype(session.k), copy=False))
+        _write_array(archive, 'centroids.npy', np.asarray(session.centroids, dtype=np.float32))
+        _write_array(archive, 'mean_spectra.npy', np.asarray(session.mean_spectra, dtype=np.float32))
+        _write_array(archive, 'counts.npy', np.asarray(session.counts, dtype=np.int64))
+        _write_array(archive, 'xdata.npy', np.asarray(session.xdata, dtype=np.float32))
+        for number, layer in enumerate(layers):
+            _write_array(archive, f'layers/{number:03d}.npy', np.asarray(layer.image, dtype=np.float32))
+
+
+def _settings(cls, values):
+    # Settings namedtuple from its manifest dict; lists are turned back into hashable tuples
+    values = {key: tuple(value) if isinstance(value, list) else value for key, value in values.items()}
+    return cls(**{key: value for key, value in values.items() if key in cls._fields})
+
+
+def import_session(source, directory):
+    """Session read from a path or binary file object, with its arrays memory-mapped from `directory`.
+
+    The directory must outlive the returned arrays. Raises ValueError for files that are
+    not session archives.
+    """
+    try:
+        archive = zipfile.ZipFile(source)
+    except zipfile.BadZipFile:
+        raise ValueError("Not a session file (not a zip archive).")
+
+    with archive:
+        try:
+            manifest = json.loads(archive.read('manifest.json'))
+        except (KeyError, json.JSONDecodeError):
+            raise ValueError("Not a session file (no manifest).")
+        if manifest.get('format') != FORMAT:
+            raise ValueError("Not a session file.")
+        if manifest.get('version', 0) > VERSION:
+            raise ValueError(f"Session format version {manifest['version']} is newer than this app supports.")
+
+        def load(name):
+            # Extract a chunk at a time, then map the .npy file read-only
+            path = os.path.join(directory, name.replace('/', '_'))
+            with archive.open(name) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_BYTES)
+            return np.load(path, mmap_mode='r', allow_pickle=False)
+
+        try:
+            arrays = {name: load(f'{name}.npy') for name in ('labels', 'centroids', 'mean_spectra', 'counts', 'xdata')}
+            layers = [Layer(name=info['name'], image=load(f'layers/{number:03d}.npy'), colour=info['colour'],
+                            vmin=info['vmin'], vmax=info['vmax'])
+                      for number, info in enumerate(manifest['layers'])]
+        except KeyError as e:
+            raise ValueError(f"Incomplete session file: {e}")
+
+    method = manifest['method']
+    return Session(name=manifest['name'], dataset_key=manifest['dataset'], k=manifest['k'],
+                   labels=arrays['labels'], centroids=arrays['centroids'], inertia=manifest['inertia'],
+                   mean_spectra=arrays['mean_spectra'], counts=arrays['counts'], xdata=arrays['xdata'],
+                   preprocessing=_settings(Preprocessing, manifest['preprocessing']),
+                   reduction=_settings(Reduction, manifest['reduction']),
+                   method=tuple(method) if isinstance(method, list) else method, layers=layers,
+                   spatial=_settings(Spatial, manifest.get('spatial', {})))
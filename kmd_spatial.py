@@ -0,0 +1,162 @@
+from collections import namedtuple
+
+import numpy as np
+
+from kmd_cluster import ClusterModel, iter_row_blocks, rows_per_block
+from kmd_io import Cube
+from kmd_spectra import cluster_sums
+
+
+# Tasks - Spatially aware clustering
+#
+# K-means labels every pixel on its own spectrum. Neighbouring pixels can be brought in
+# before the fit (neighbourhood-averaged features) and after it (a Potts-model smoothing of
+# the labels by iterated conditional modes, then a minimum size for connected regions).
+
+
+# Spatial settings, hashable so they can be part of the cache and ModelStore keys.
+#   radius:     neighbourhood features: each spectrum is blended with the mean of the
+#               (2 radius + 1)^2 pixels around it (0 turns this off)
+#   weight:     share of the neighbourhood mean in the blend
+#   beta:       label smoothing strength: the cost of disagreeing with one of the four
+#               neighbours, in units of the mean squared distance to the own centroid (0 = off)
+#   iterations: maximum sweeps of the label smoothing
+#   min_size:   connected regions with fewer pixels join the surrounding clusters (0 = off)
+Spatial = namedtuple('Spatial', ['radius', 'weight', 'beta', 'iterations', 'min_size'],
+                     defaults=[0, 0.5, 0.0, 10, 0])
+
+NO_SPATIAL = Spatial()
+
+# The four neighbours of a pixel
+NEIGHBOURS = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype=np.float32)
+
+
+def feature_settings(spatial):
+    # The part of the settings that changes what K-means is fitted on
+    return Spatial(radius=spatial.radius, weight=spatial.weight) if spatial.radius > 0 else NO_SPATIAL
+
+
+def refines(spatial):
+    # True when the labels are post-processed after the fit
+    return spatial.beta > 0 or spatial.min_size > 1
+
+
+def neighbourhood_features(cube, radius, weight, out=None, block_rows=64):
+    """Cube of float32 spectra blended with the mean spectrum of their neighbourhood.
+
+    The mean runs over a (2 radius + 1) x (2 radius + 1) window, edges repeated. Pass `out`
+    (e.g. a memory-mapped array of the cube's shape) to keep the result off the heap; the
+    blend is finished `block_rows` map rows at a time.
+    """
+    from scipy.ndimage import uniform_filter
+
+    size = 2 * radius + 1
+    if out is None:
+        out = np.empty(cube.shape, dtype=np.float32)
+    uniform_filter(cube.spectra, size=(size, size, 1), output=out, mode='nearest')
+    for start in range(0, cube.shape[0], block_rows):
+        rows = out[start:start + block_rows]
+        rows *= np.float32(weight)
+        rows += np.float32(1 - weight) * np.asarray(cube.spectra[start:start + block_rows], dtype=np.float32)
+
+    return Cube(spectra=out, xdata=cube.xdata, shape=out.shape)
+
+
+def centroid_distances(spectra, centroids, budget_bytes, transform=None):
+    # (pixels, k) squared distances of every pixel to every centroid, a block of rows at a time
+    rows, cols, _ = spectra.shape
+    centroids = np.asarray(centroids, dtype=np.float32)
+    norms = (centroids ** 2).sum(axis=1)
+
+    distances = np.empty((rows * cols, len(centroids)), dtype=np.float32)
+    for offset, block in iter_row_blocks(spectra, rows_per_block(spectra.shape, budget_bytes)):
+        if transform is not None:
+            block = np.asarray(transform(block), dtype=np.float32)
+        block_distances = (block ** 2).sum(axis=1)[:, None] + norms - 2 * block @ centroids.T
+        distances[offset:offset + len(block)] = np.maximum(block_distances, 0)
+    return distances
+
+
+def smooth_labels(distances, labels, shape, beta, iterations=10):
+    """Labels smoothed by iterated conditional modes on a Potts model over the 4-neighbour grid.
+
+    Each pixel takes the cluster minimising its squared distance to the centroid (scaled by
+    the mean of those distances under the current labels) minus `beta` for every neighbour
+    already in that cluster. The two colours of a checkerboard are updated in turn, so no
+    pixel changes at the same time as its neighbours; it stops when nothing changes.
+    """
+    from scipy.ndimage import correlate
+
+    rows, cols = shape
+    k = distances.shape[1]
+    labels = np.asarray(labels).reshape(shape).copy()
+    unit = float(distances[np.arange(len(distances)), labels.ravel()].mean())
+    cost = (distances / max(unit, np.finfo(np.float32).tiny)).reshape(rows, cols, k)
+    colours = np.add.outer(np.arange(rows), np.arange(cols)) % 2
+
+    for _ in range(iterations):
+        changed = 0
+        for colour in (0, 1):
+            onehot = (labels[..., None] == np.arange(k)).astype(np.float32)
+            agree = correlate(onehot, NEIGHBOURS[..., None], mode='constant')
+            best = (cost - np.float32(beta) * agree).argmin(axis=2)
+            update = (colours == colour) & (best != labels)
+            labels[update] = best[update]
+            changed += int(update.sum())
+        if not changed:
+            break
+
+    return labels.ravel()
+
+
+def remove_small_regions(labels_2d, min_size):
+    """Labels with every connected region under `min_size` pixels given the label of the nearest kept pixel."""
+    from scipy.ndimage import distance_transform_edt, label
+
+    keep = np.ones(labels_2d.shape, dtype=bool)
+    for cluster in np.unique(labels_2d):
+        regions, _ = label(labels_2d == cluster)
+        small = np.bincount(regions.ravel()) < min_size
+        small[0] = False
+        keep &= ~small[regions]
+    if keep.all() or not keep.any():
+        return labels_2d
+
+    _, (nearest_rows, nearest_cols) = distance_transform_edt(~keep, return_indices=True)
+    return labels_2d[nearest_rows, nearest_cols]
+
+
+def spatial_refine(model, spectra, spatial, budget_bytes, transform=None):
+    """ClusterModel with smoothed labels and small regions removed.
+
+    `spectra` is the (rows, columns, channels) cube the model was fitted on, or the raw cube
+    with the `transform` that takes blocks of it there. The centroids become the exact means
+    of the new clusters (a cluster left without pixels keeps its centroid) and the inertia is
+    measured against them.
+    """
+    shape = spectra.shape[:2]
+    distances = centroid_distances(spectra, model.centroids, budget_bytes, transform)
+    labels = np.asarray(model.labels, dtype=np.int32)
+    if spatial.beta > 0:
+        labels = smooth_labels(distances, labels, shape, spatial.beta, spatial.iterations)
+    if spatial.min_size > 1:
+        labels = remove_small_regions(labels.reshape(shape), spatial.min_size).ravel()
+    labels = labels.astype(np.int32)
+
+    # Exact cluster means in one more pass
+    centroids = np.asarray(model.centroids, dtype=np.float32)
+    k = len(centroids)
+    sums = np.zeros(centroids.shape, dtype=np.float64)
+    for offset, block in iter_row_blocks(spectra, rows_per_block(spectra.shape, budget_bytes)):
+        if transform is not None:
+            block = np.asarray(transform(block), dtype=np.float32)
+        sums += cluster_sums(block, labels[offset:offset + len(block)], k)
+    counts = np.bincount(labels, minlength=k)
+    means = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+
+    # Squared distances to the old centroids, less what moving each centroid to its mean saves
+    inertia = float(distances[np.arange(len(labels)), labels].sum(dtype=np.float64)
+                    - (counts * ((means - centroids) ** 2).sum(axis=1)).sum())
+
+    return ClusterModel(labels=labels, centroids=means.astype(np.float32), inertia=max(inertia, 0.0),
+                        n_iter=model.n_iter)
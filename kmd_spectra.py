@@ -0,0 +1,173 @@
+import numpy as np
+
+
+# Tasks - Spectral reductions on label arrays
+
+
+def cluster_sums(data_matrix, labels, k):
+    # Per-cluster sums of the rows of data_matrix as one (k, pixels) x (pixels, channels) product
+    onehot = (labels[None, :] == np.arange(k)[:, None]).astype(data_matrix.dtype)
+    return onehot @ data_matrix
+
+
+def cluster_mean_spectra(spectra, labels, k, block_pixels=8192):
+    """Mean spectrum and pixel count of every cluster in a single pass over the cube.
+
+    `spectra` is a (rows, columns, channels) cube or a (pixels, channels) matrix and may be
+    memory-mapped: it is read `block_pixels` rows at a time, so no copy of the cube is made.
+    """
+    data_matrix = spectra.reshape((-1, spectra.shape[-1]))
+
+    sums = np.zeros((k, data_matrix.shape[1]), dtype=np.float64)
+    for start in range(0, len(data_matrix), block_pixels):
+        sums += cluster_sums(data_matrix[start:start + block_pixels], labels[start:start + block_pixels], k)
+
+    counts = np.bincount(labels, minlength=k)
+    means = sums / np.maximum(counts, 1)[:, None]
+
+    return means.astype(np.float32), counts
+
+
+def band_intensity_map(spectra, labels, cluster, band, weights, block_pixels=8192):
+    """Image of a weighted band integral, zero outside the selected cluster.
+
+    `band` is a slice of channel positions and `weights` the matching weight vector from
+    WavenumberIndex.band_weights; only those columns of the cube are read.
+    """
+    rows, cols, channels = spectra.shape
+    data_matrix = spectra.reshape((rows * cols, channels))
+    weights = np.asarray(weights, dtype=data_matrix.dtype)
+
+    image = np.zeros(rows * cols, dtype=np.float32)
+    for start in range(0, len(image), block_pixels):
+        image[start:start + block_pixels] = data_matrix[start:start + block_pixels, band] @ weights
+    image[labels != cluster] = 0
+
+    return image.reshape((rows, cols))
+
+
+def band_intensity_maps(spectra, labels, clusters, bands, block_pixels=8192):
+    """Several band images from a single pass over the cube, shape (len(bands), rows, columns).
+
+    `bands` holds (slice, weights) pairs from WavenumberIndex.band_weights and `clusters` the
+    cluster kept in each image. All bands are stacked into one weight matrix, so each block
+    of pixels is read once and reduced with a single matrix product.
+    """
+    rows, cols, channels = spectra.shape
+    data_matrix = spectra.reshape((rows * cols, channels))
+
+    first = min(band.start for band, _ in bands)
+    last = max(band.stop for band, _ in bands)
+    weight_matrix = np.zeros((last - first, len(bands)), dtype=data_matrix.dtype)
+    for i, (band, weights) in enumerate(bands):
+        weight_matrix[band.start - first:band.stop - first, i] = weights
+
+    maps = np.empty((rows * cols, len(bands)), dtype=np.float32)
+    for start in range(0, len(maps), block_pixels):
+        maps[start:start + block_pixels] = data_matrix[start:start + block_pixels, first:last] @ weight_matrix
+    maps[labels[:, None] != np.asarray(clusters)[None, :]] = 0
+
+    return np.ascontiguousarray(maps.T).reshape((len(bands), rows, cols))
+
+
+class WavenumberIndex:
+    """Sorted wavenumber axis answering band queries by binary search.
+
+    Works for ascending and descending axes; any pair of floats is a valid range.
+    """
+
+    def __init__(self, xdata):
+        self.xdata = np.asarray(xdata, dtype=np.float64)
+        self.descending = len(self.xdata) > 1 and self.xdata[0] > self.xdata[-1]
+        self._sorted = self.xdata[::-1] if self.descending else self.xdata
+        if np.any(np.diff(self._sorted) < 0):
+            raise ValueError("The wavenumber axis is not monotonic.")
+
+    def __len__(self):
+        return len(self.xdata)
+
+    def _column(self, sorted_pos):
+        # Column offset in the cube for a position in the ascending axis
+        return len(self.xdata) - 1 - sorted_pos if self.descending else sorted_pos
+
+    def clip(self, start, end):
+        # Range ordered low to high and limited to the axis, or None if it misses the axis
+        lo, hi = sorted((float(start), float(end)))
+        lo, hi = max(lo, self._sorted[0]), min(hi, self._sorted[-1])
+        if lo > hi:
+            return None
+        return lo, hi
+
+    def channels(self, start, end):
+        # Slice of the columns whose wavenumber lies inside the range
+        lo, hi = sorted((float(start), float(end)))
+        i = int(np.searchsorted(self._sorted, lo, side='left'))
+        j = int(np.searchsorted(self._sorted, hi, side='right'))
+        if self.descending:
+            return slice(len(self.xdata) - j, len(self.xdata) - i)
+        return slice(i, j)
+
+    def _interpolation(self, x):
+        # Weights of the two channels that linearly interpolate the spectrum at x
+        n = len(self._sorted)
+        i = int(np.clip(np.searchsorted(self._sorted, x, side='right') - 1, 0, max(n - 2, 0)))
+        if n == 1 or self._sorted[i + 1] == self._sorted[i]:
+            return {i: 1.0}
+        t = (x - self._sorted[i]) / (self._sorted[i + 1] - self._sorted[i])
+        return {i: 1.0 - t, i + 1: t}
+
+    def band_weights(self, start, end, method='mean', baseline='none'):
+        """Column slice and weights so that `spectra[..., band] @ weights` integrates the band.
+
+        method: 'mean' averages the channels inside the range (the spectrum interpolated at
+        its centre when no channel falls inside); 'trapezoid' integrates the linearly
+        interpolated spectrum exactly between the two range ends.
+        baseline: 'linear' subtracts the straight line joining the interpolated intensities
+        at the two range ends.
+        """
+        clipped = self.clip(start, end)
+        if clipped is None:
+            raise ValueError("The range lies outside the spectrum.")
+        lo, hi = clipped
+
+        dense = np.zeros(len(self._sorted), dtype=np.float64)
+        def add(terms, scale):
+            for pos, w in terms.items():
+                dense[pos] += scale * w
+
+        i = int(np.searchsorted(self._sorted, lo, side='left'))
+        j = int(np.searchsorted(self._sorted, hi, side='right'))
+        inside = np.arange(i, j)
+        at_lo, at_hi = self._interpolation(lo), self._interpolation(hi)
+
+        if method == 'trapezoid':
+            # Knots: interpolated ends plus every channel in between
+            knots = [(lo, at_lo)] + [(self._sorted[p], {p: 1.0}) for p in inside] + [(hi, at_hi)]
+            for (x0, w0), (x1, w1) in zip(knots[:-1], knots[1:]):
+                add(w0, (x1 - x0) / 2)
+                add(w1, (x1 - x0) / 2)
+            if baseline == 'linear':
+                add(at_lo, -(hi - lo) / 2)
+                add(at_hi, -(hi - lo) / 2)
+        elif method == 'mean':
+            if len(inside) == 0:
+                add(self._interpolation((lo + hi) / 2), 1.0)
+                t = np.array([0.5])
+            else:
+                dense[inside] += 1.0 / len(inside)
+                t = (self._sorted[inside] - lo) / (hi - lo) if hi > lo else np.full(len(inside), 0.5)
+            if baseline == 'linear':
+                add(at_lo, -(1 - t.mean()))
+                add(at_hi, -t.mean())
+        else:
+            raise ValueError(f"Unknown band integration method: {method}")
+
+        # Trim to the columns actually used and put the weights in cube column order
+        used = np.flatnonzero(dense)
+        if len(used) == 0:
+            used = inside if len(inside) else np.array([i if i < len(dense) else len(dense) - 1])
+        first, last = used.min(), used.max()
+        weights = dense[first:last + 1]
+        if self.descending:
+            return slice(self._column(last), self._column(first) + 1), weights[::-1].copy()
+        return slice(first, last + 1), weights
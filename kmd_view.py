@@ -0,0 +1,205 @@
+import base64
+import json
+
+import numpy as np
+
+
+# Tasks - Interactive cluster view drawn in the browser
+#
+# The label map, the cluster mean spectra and (for small enough maps) every pixel's spectrum
+# are sent once as base64 typed arrays; highlighting, comparing clusters and hovering pixels
+# then happen in the page's own JavaScript without a rerun.
+
+
+# Display resolution of the spectra: each bin keeps its minimum and maximum, so peaks survive
+SPECTRUM_BINS = 256
+
+# Per-pixel spectra are only embedded while they stay below this size
+PIXEL_SPECTRA_BYTES = 8 * 1024 * 1024
+
+
+def _b64(array, dtype):
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode('ascii')
+
+
+def minmax_decimate(xdata, spectra, bins=SPECTRUM_BINS):
+    """Axis and (n, points) values reduced to the minimum and maximum of each channel bin.
+
+    Each bin contributes two points in the order they occur in the spectrum, so a line
+    through them keeps every peak and trough. Spectra short enough to show in full are
+    returned unchanged.
+    """
+    xdata = np.asarray(xdata, dtype=np.float32)
+    spectra = np.asarray(spectra, dtype=np.float32)
+    n = spectra.shape[1]
+    if n <= 2 * bins:
+        return xdata, spectra
+
+    # Pad with the last channel so the channels split into equal bins without changing any extreme
+    width = -(-n // bins)
+    bins = -(-n // width)
+    pad = bins * width - n
+    padded = np.pad(spectra, ((0, 0), (0, pad)), mode='edge').reshape(len(spectra), bins, width)
+    lo, hi = padded.argmin(axis=2), padded.argmax(axis=2)
+    first, second = np.minimum(lo, hi), np.maximum(lo, hi)
+    values = np.stack([np.take_along_axis(padded, first[..., None], 2)[..., 0],
+                       np.take_along_axis(padded, second[..., None], 2)[..., 0]], axis=2)
+
+    centres = np.pad(xdata, (0, pad), mode='edge').reshape(bins, width).mean(axis=1)
+    return np.repeat(centres, 2), values.reshape(len(spectra), 2 * bins)
+
+
+def pixel_spectra_payload(spectra, bins=SPECTRUM_BINS, block_pixels=8192, max_bytes=PIXEL_SPECTRA_BYTES):
+    # Decimated spectrum of every pixel as uint16 over one shared range, or None when too large
+    rows, cols, channels = spectra.shape
+    points = channels if channels <= 2 * bins else 2 * -(-channels // -(-channels // bins))
+    if rows * cols * points * 2 > max_bytes:
+        return None
+
+    data_matrix = spectra.reshape((rows * cols, channels))
+    values = np.empty((rows * cols, points), dtype=np.float32)
+    for start in range(0, len(values), block_pixels):
+        values[start:start + block_pixels] = minmax_decimate(np.arange(channels), data_matrix[start:start + block_pixels], bins)[1]
+
+    lo, hi = float(values.min()), float(values.max())
+    scale = 65535 / (hi - lo) if hi > lo else 0.0
+    quantised = np.rint((values - lo) * scale).astype(np.uint16)
+    return {'values': _b64(quantised, '<u2'), 'lo': lo, 'hi': hi}
+
+
+def interactive_view_html(labels_2d, xdata, mean_spectra, colours, pixel_spectra=None, height=460):
+    """Self-contained HTML page with the cluster map, a cluster picker and a spectrum plot.
+
+    `colours` holds one CSS colour per cluster; `pixel_spectra` is the output of
+    pixel_spectra_payload (or None, in which case hovering shows the pixel's cluster mean).
+    """
+    rows, cols = labels_2d.shape
+    x, means = minmax_decimate(xdata, mean_spectra)
+    payload = {
+        'rows': rows, 'cols': cols, 'k': len(mean_spectra), 'height': height,
+        'labels': _b64(labels_2d, np.uint8),
+        'x': _b64(x, '<f4'),
+        'means': _b64(means, '<f4'),
+        'counts': np.bincount(labels_2d.ravel(), minlength=len(mean_spectra)).tolist(),
+        'colours': list(colours),
+        'pixels': pixel_spectra,
+    }
+    return VIEW_TEMPLATE.replace('__DATA__', json.dumps(payload))
+
+
+VIEW_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><style>
+body { margin: 0; font-family: sans-serif; font-size: 13px; color: #262730; }
+#wrap { display: flex; gap: 16px; }
+#map { image-rendering: pixelated; border: 1px solid #ccc; cursor: crosshair; }
+#picker { display: flex; flex-wrap: wrap; gap: 6px; margin: 6px 0; max-width: 380px; }
+#picker button { border: 1px solid #ccc; background: #fff; border-radius: 4px; padding: 2px 6px; cursor: pointer; }
+#picker button.on { border-color: #262730; font-weight: bold; }
+#picker span { display: inline-block; width: 10px; height: 10px; margin-right: 4px; }
+#info { height: 18px; }
+</style></head><body>
+<div id="wrap">
+  <div><canvas id="map"></canvas><div id="picker"></div><div id="info">Hover over the map; click a cluster to compare it.</div></div>
+  <canvas id="plot"></canvas>
+</div>
+<script>
+const D = __DATA__;
+function decode(text, Type) {
+  const bin = atob(text), bytes = new Uint8Array(bin.length);
+  for (let i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+  return new Type(bytes.buffer);
+}
+const labels = decode(D.labels, Uint8Array), x = decode(D.x, Float32Array), means = decode(D.means, Float32Array);
+const m = x.length, pixels = D.pixels ? decode(D.pixels.values, Uint16Array) : null;
+const pm = pixels ? pixels.length / (D.rows * D.cols) : 0;
+const selected = new Set([0]);
+let hover = null;
+
+function rgb(css) { const c = document.createElement('canvas').getContext('2d'); c.fillStyle = css; const h = c.fillStyle;
+  return [parseInt(h.slice(1, 3), 16), parseInt(h.slice(3, 5), 16), parseInt(h.slice(5, 7), 16)]; }
+const palette = D.colours.map(rgb);
+
+// Map: one canvas pixel per map pixel, scaled up by CSS without smoothing
+const map = document.getElementById('map');
+map.width = D.cols; map.height = D.rows;
+const side = 360, scale = Math.min(side / D.cols, side / D.rows);
+map.style.width = (D.cols * scale) + 'px'; map.style.height = (D.rows * scale) + 'px';
+const image = map.getContext('2d').createImageData(D.cols, D.rows);
+function drawMap() {
+  for (let i = 0; i < labels.length; i++) {
+    const c = palette[labels[i]], on = selected.size === 0 || selected.has(labels[i]);
+    for (let j = 0; j < 3; j++) image.data[4 * i + j] = on ? c[j] : 235 + (c[j] - 235) * 0.15;
+    image.data[4 * i + 3] = 255;
+  }
+  map.getContext('2d').putImageData(image, 0, 0);
+}
+
+// Cluster picker: any number of clusters can be compared
+const picker = document.getElementById('picker');
+for (let c = 0; c < D.k; c++) {
+  const b = document.createElement('button');
+  b.innerHTML = '<span style="background:' + D.colours[c] + '"></span>' + c + ' (' + D.counts[c] + ')';
+  b.onclick = () => { selected.has(c) ? selected.delete(c) : selected.add(c); refresh(); };
+  picker.appendChild(b);
+}
+
+// Spectrum plot
+const plot = document.getElementById('plot');
+plot.width = 560; plot.height = D.height - 10;
+const pad = {l: 60, r: 10, t: 10, b: 36};
+function series() {
+  const out = [...selected].sort((a, b) => a - b).map(c => ({ y: means.subarray(c * m, (c + 1) * m), colour: D.colours[c], width: 2 }));
+  if (hover) {
+    if (pixels) {
+      const q = pixels.subarray(hover.index * pm, (hover.index + 1) * pm), span = (D.pixels.hi - D.pixels.lo) / 65535;
+      out.push({ y: Float32Array.from(q, v => D.pixels.lo + v * span), colour: '#000', width: 1 });
+    } else {
+      out.push({ y: means.subarray(hover.cluster * m, (hover.cluster + 1) * m), colour: '#000', width: 1, dash: [4, 3] });
+    }
+  }
+  return out;
+}
+function drawPlot() {
+  const g = plot.getContext('2d'), w = plot.width - pad.l - pad.r, h = plot.height - pad.t - pad.b;
+  g.clearRect(0, 0, plot.width, plot.height);
+  const lines = series();
+  let xmin = Infinity, xmax = -Infinity, ymin = Infinity, ymax = -Infinity;
+  for (const v of x) { xmin = Math.min(xmin, v); xmax = Math.max(xmax, v); }
+  for (const s of lines) for (const v of s.y) { ymin = Math.min(ymin, v); ymax = Math.max(ymax, v); }
+  if (!lines.length) { ymin = 0; ymax = 1; }
+  if (ymax === ymin) { ymax += 1; ymin -= 1; }
+  const px = v => pad.l + (v - xmin) / (xmax - xmin) * w, py = v => pad.t + (ymax - v) / (ymax - ymin) * h;
+  g.strokeStyle = '#999'; g.lineWidth = 1; g.strokeRect(pad.l, pad.t, w, h);
+  g.fillStyle = '#262730'; g.font = '11px sans-serif';
+  g.textAlign = 'center';
+  for (let i = 0; i <= 4; i++) { const v = xmin + (xmax - xmin) * i / 4; g.fillText(v.toFixed(0), px(v), pad.t + h + 14); }
+  g.fillText('Wavenumber', pad.l + w / 2, pad.t + h + 30);
+  g.textAlign = 'right';
+  for (let i = 0; i <= 4; i++) { const v = ymin + (ymax - ymin) * i / 4; g.fillText(v.toPrecision(4), pad.l - 4, py(v) + 4); }
+  for (const s of lines) {
+    g.strokeStyle = s.colour; g.lineWidth = s.width; g.setLineDash(s.dash || []);
+    g.beginPath();
+    for (let i = 0; i < m; i++) { i ? g.lineTo(px(x[i]), py(s.y[i])) : g.moveTo(px(x[i]), py(s.y[i])); }
+    g.stroke();
+  }
+  g.setLineDash([]);
+}
+
+function refresh() {
+  [...picker.children].forEach((b, c) => b.classList.toggle('on', selected.has(c)));
+  drawMap(); drawPlot();
+}
+map.addEventListener('mousemove', e => {
+  const col = Math.min(D.cols - 1, Math.floor(e.offsetX / scale)), row = Math.min(D.rows - 1, Math.floor(e.offsetY / scale));
+  const index = row * D.cols + col;
+  if (hover && hover.index === index) return;
+  hover = { index: index, cluster: labels[index] };
+  document.getElementById('info').textContent = 'Row ' + row + ', column ' + col + ': cluster ' + hover.cluster +
+    (pixels ? '' : ' (cluster mean shown)');
+  drawPlot();
+});
+map.addEventListener('mouseleave', () => { hover = null; drawPlot(); });
+map.addEventListener('click', () => { if (hover) { selected.has(hover.cluster) ? selected.delete(hover.cluster) : selected.add(hover.cluster); refresh(); } });
+refresh();
+</script></body></html>
+"""